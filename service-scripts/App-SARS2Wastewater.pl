@@ -24,7 +24,58 @@ $app->run(\@ARGV);
 sub run_app
 {
     my($app, $app_def, $raw_params, $params) = @_;
+    if ($params->{recompute_from_job})
+    {
+	process_recompute_input($app, $params);
+    }
+    else
+    {
 	process_read_input($app, $params);
+    }
+}
+
+#
+# Demix recompute: pull the barcode independent freyja variants and depths
+# (plus the assembly stats) of an earlier job's output folder instead of reads,
+# so only demix and the wrap up run again with the current barcodes.
+#
+sub process_recompute_input
+{
+    my($app, $params) = @_;
+
+    my $top = getcwd;
+    my $staging = "$top/staging";
+    my $output = "$top/output";
+    my $previous = "$staging/previous_job";
+    make_path($staging, $output, $previous);
+
+    my $previous_folder = $params->{recompute_from_job};
+    $previous_folder =~ s,/+$,,;
+    my $listing;
+    my $ok = IPC::Run::run(["p3-ls", "ws:$previous_folder"], '>', \$listing);
+    if (!$ok)
+    {
+	die "Error $? listing previous job output folder $previous_folder\n";
+    }
+    for my $entry (split(/\n/, $listing))
+    {
+	$entry =~ s,/+$,,;
+	next if ($entry eq "" || $entry =~ /^\./);
+	if ($entry eq "sample_registry.json")
+	{
+	    IPC::Run::run(["p3-cp", "ws:$previous_folder/$entry", "$previous/"]);
+	    next;
+	}
+	# every sample has its own folder, skip the files and folders without freyja variants
+	make_path("$previous/$entry/assembly");
+	my @cmd = ("p3-cp", "--recursive", "ws:$previous_folder/$entry/freyja", "$previous/$entry/");
+	print STDERR "copying previous freyja results @cmd\n";
+	IPC::Run::run(\@cmd, '2>', \my $err) or next;
+	IPC::Run::run(["p3-cp", "ws:$previous_folder/$entry/assembly/$entry.statistics.tsv", "$previous/$entry/assembly/"], '2>', \my $stats_err);
+    }
+    $params->{$_} = [] foreach qw(single_end_libs paired_end_libs srr_libs);
+
+    run_workflow($app, $params, $top, $staging, $output, "0", $previous);
 }
 
 sub process_read_input
@@ -103,6 +154,13 @@ sub process_read_input
         }
     }
 
+    run_workflow($app, $params, $top, $staging, $output, $staging_sample_metadata_path, "");
+}
+
+sub run_workflow
+{
+    my($app, $params, $top, $staging, $output, $staging_sample_metadata_path, $recompute_dir) = @_;
+
     print STDERR "Starting the config json....\n";
     my $json_string = encode_json($params);
 
@@ -164,6 +222,20 @@ sub process_read_input
     $config_vars{output_data_dir} = $output;
     $config_vars{snakemake} = $snakemake;
     $config_vars{cores} = $ENV{P3_ALLOCATED_CPU} // 2;
+    # memory budget the wrapper hands to snakemake, defaults to the preflight request
+    $config_vars{memory} = $ENV{P3_ALLOCATED_MEMORY} // '16G';
+    # per sample result cache shared between jobs, only used when the directory exists and is writable
+    my $result_cache_dir = $ENV{P3_SARS2WASTEWATER_RESULT_CACHE} // application_backend_dir . "/bvbrc_SARS2Wastewater/result_cache";
+    $config_vars{result_cache_dir} = (-d $result_cache_dir && -w $result_cache_dir) ? $result_cache_dir : "";
+    $config_vars{result_cache_max_gb} = $ENV{P3_SARS2WASTEWATER_RESULT_CACHE_MAX_GB} // 500;
+    # primer schemes as <primers>/<version>/*.primer.bed and *.reference.fasta for the FASTQ preflight
+    # primer start check and the amplicon downsampling, both are left out when the directory does not exist
+    my $primer_schemes_dir = $ENV{P3_SARS2WASTEWATER_PRIMER_SCHEMES} // "";
+    $config_vars{primer_schemes_dir} = ($primer_schemes_dir ne "" && -d $primer_schemes_dir) ? $primer_schemes_dir : "";
+    # reads kept per amplicon before the assembly, 0 or no primer schemes assembles every read
+    $config_vars{downsample_depth} = $params->{downsample_depth} // 0;
+    # earlier job output with the freyja variants and depths for a demix recompute
+    $config_vars{recompute_dir} = $recompute_dir;
 
     # add the params to the config file
     $config_vars{params} = $params;
@@ -190,6 +262,17 @@ sub preflight
 {
     my($app, $app_def, $raw_params, $params) = @_;
 
+    # a demix recompute only downloads the small freyja variants and depths files
+    if ($params->{recompute_from_job})
+    {
+	return {
+	    cpu => 6,
+	    memory => '16G',
+	    runtime => 60 * 60 * 2,
+	    storage => 10 * 1024 * 1024 * 1024,
+	};
+    }
+
     my $readset = Bio::KBase::AppService::ReadSet->create_from_asssembly_params($params);
 
     my($ok, $errs, $comp_size, $uncomp_size) = $readset->validate($app->workspace);
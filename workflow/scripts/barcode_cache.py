@@ -0,0 +1,104 @@
+import click
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import sys
+
+#
+# Memory-mappable copy of the freyja barcode matrix.
+# The barcodes (lineages x mutations) are converted once into a column-major
+# .npy file, keyed by the checksum of the source file, next to the source.
+# Every demix worker on the node - in this job and in any other job running
+# at the same time - maps the same read-only pages instead of holding its own
+# parsed copy of the barcodes.
+#
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_barcodes(barcodes_path):
+    if barcodes_path.endswith(".feather"):
+        df_barcodes = pd.read_feather(barcodes_path)
+        if "index" in df_barcodes.columns:
+            df_barcodes = df_barcodes.set_index("index")
+    else:
+        df_barcodes = pd.read_csv(barcodes_path, index_col=0)
+    return df_barcodes
+
+
+def clean_barcodes(df_barcodes, confirmed_only):
+    # same barcode clean up as freyja demix
+    if confirmed_only:
+        confirmed = [dfi for dfi in df_barcodes.index if "proposed" not in dfi and "misc" not in dfi]
+        df_barcodes = df_barcodes.loc[confirmed, :]
+    # drop intra-lineage diversity naming (keeps separate barcodes)
+    index_simplified = [dfi.split("_")[0] for dfi in df_barcodes.index]
+    df_barcodes = df_barcodes.loc[~pd.Index(index_simplified).duplicated(), :]
+    return df_barcodes
+
+
+def cache_paths(barcodes_path, confirmed_only, cache_dir=None):
+    checksum = file_sha256(barcodes_path)[:16]
+    variant = "confirmed" if confirmed_only else "all"
+    cache_dir = cache_dir or os.path.dirname(os.path.abspath(barcodes_path))
+    base = os.path.join(cache_dir, f"{os.path.basename(barcodes_path)}.{checksum}.{variant}")
+    return f"{base}.npy", f"{base}.index.json"
+
+
+def write_barcode_cache(barcodes_path, confirmed_only, matrix_path, index_path):
+    df_barcodes = clean_barcodes(read_barcodes(barcodes_path), confirmed_only)
+    values = df_barcodes.to_numpy()
+    # barcodes are 0/1, keep them as bytes unless a custom barcode file holds other values
+    if np.isin(values, (0, 1)).all():
+        values = values.astype(np.uint8)
+    # column-major so each mutation's lineage column is contiguous
+    values = np.asfortranarray(values)
+    # write under a private name and rename so other jobs never map a partial file
+    tmp_suffix = f".{os.getpid()}.tmp"
+    with open(matrix_path + tmp_suffix, "wb") as fh:
+        np.save(fh, values)
+    with open(index_path + tmp_suffix, "w") as fh:
+        json.dump({"lineages": df_barcodes.index.tolist(), "mutations": df_barcodes.columns.tolist()}, fh)
+    os.replace(index_path + tmp_suffix, index_path)
+    os.replace(matrix_path + tmp_suffix, matrix_path)
+    return
+
+
+def load_barcodes(barcodes_path, confirmed_only, fallback_cache_dir="tmp"):
+    # map the cached barcode matrix, building the cache first if needed
+    # the source directory may be read only for jobs, then the cache is kept with the job
+    cache_dir = os.path.dirname(os.path.abspath(barcodes_path))
+    if not os.access(cache_dir, os.W_OK):
+        cache_dir = fallback_cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+    matrix_path, index_path = cache_paths(barcodes_path, confirmed_only, cache_dir)
+    if not (os.path.isfile(matrix_path) and os.path.isfile(index_path)):
+        msg = f"building barcode cache {matrix_path} \n"
+        sys.stderr.write(msg)
+        write_barcode_cache(barcodes_path, confirmed_only, matrix_path, index_path)
+    with open(index_path) as fh:
+        index = json.load(fh)
+    values = np.load(matrix_path, mmap_mode="r")
+    return pd.DataFrame(values, index=index["lineages"], columns=index["mutations"], copy=False)
+
+
+@click.command()
+@click.argument("barcodes_path")
+@click.option("--confirmedonly", is_flag=True, help="build the cache for --confirmedonly demix")
+def cli(barcodes_path, confirmedonly):
+    # build the cache ahead of time, e.g. right after the barcodes are updated
+    matrix_path, index_path = cache_paths(barcodes_path, confirmedonly)
+    if not (os.path.isfile(matrix_path) and os.path.isfile(index_path)):
+        write_barcode_cache(barcodes_path, confirmedonly, matrix_path, index_path)
+    print(matrix_path)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,170 @@
+import os
+# one BLAS thread per solve, the worker pool provides the parallelism
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+
+import click
+import importlib.metadata
+import inspect
+import json
+import multiprocessing
+import pandas as pd
+import sys
+import time
+
+from barcode_cache import load_barcodes
+from freyja_aggregator import add_sample
+from job_state import JobState
+
+#
+# Batch freyja demix for every sample of the job.
+# freyja demix re-reads the barcodes and lineage metadata for every sample,
+# here they are loaded once and the samples are solved in a pool of forked
+# workers that share the loaded barcodes. Writes the same per sample
+# {sample}_freyja_result.tsv as the freyja_demix rule and adds each result to
+# the cohort aggregate as it comes back from the pool. Samples that fail here
+# are left without a result so the freyja_demix rule runs them with the CLI.
+# The solver is called through freyja's sample_deconv functions, which are
+# not a stable API: when the installed freyja lacks one of them or one of the
+# options passed, the whole batch is skipped and every sample goes to the CLI.
+# The barcodes are memory-mapped from the cache built by barcode_cache.py, so
+# demix workers of other jobs on the node share the same pages.
+#
+
+# loaded once in the parent process and inherited by the forked workers
+BARCODES = None
+LINEAGE_MAP = None
+DEMIX_PARAMS = None
+
+
+# options of freyja.sample_deconv.solve_demixing_problem the batch passes, as the freyja demix CLI does
+SOLVER_OPTIONS = ["eps", "adapt", "a_eps"]
+
+
+def freyja_version():
+    try:
+        return importlib.metadata.version("freyja")
+    except importlib.metadata.PackageNotFoundError:
+        import freyja
+        return getattr(freyja, "__version__", "unknown")
+
+
+def unsupported_options(func, options):
+    # options the installed freyja's function does not take, its signatures change between releases
+    params = inspect.signature(func).parameters
+    if any(param.kind == param.VAR_KEYWORD for param in params.values()):
+        return []
+    return [option for option in options if option not in params]
+
+
+def demix_sample(sample):
+    from freyja.sample_deconv import (build_mix_and_depth_arrays, map_to_constellation,
+                                      reindex_dfs, solve_demixing_problem)
+    start = time.time()
+    variants = f"output/{sample}/freyja/{sample}_freyja_variants.tsv"
+    depths = f"output/{sample}/freyja/{sample}_freyja.depths"
+    try:
+        mix, depths_, cov = build_mix_and_depth_arrays(variants, depths, list(BARCODES.columns), DEMIX_PARAMS["covcut"])
+        df_barcodes, mix, depths_ = reindex_dfs(BARCODES, mix, depths_)
+        sample_strains, abundances, error = solve_demixing_problem(
+            df_barcodes, mix, depths_, **{option: DEMIX_PARAMS[option] for option in SOLVER_OPTIONS})
+        local_dict = map_to_constellation(sample_strains, abundances, LINEAGE_MAP)
+    except Exception as e:
+        return sample, "failed", time.time() - start, str(e), None
+    # same layout as the freyja demix output, labeled with the variants file name
+    lineages = " ".join(sample_strains)
+    abundances = " ".join(f"{abundance:.8f}" for abundance in abundances)
+    sols_df = pd.Series(data=(local_dict, lineages, abundances, error, cov),
+                        index=["summarized", "lineages", "abundances", "resid", "coverage"],
+                        name=os.path.basename(variants))
+    sols_df.to_csv(f"output/{sample}/freyja/{sample}_freyja_result.tsv", sep="\t")
+    return sample, "complete", time.time() - start, "", sols_df
+
+
+def samples_to_demix(sample_registry):
+    # samples with freyja variants and no up to date demix result
+    samples = []
+    for sample in sample_registry:
+        variants = f"output/{sample}/freyja/{sample}_freyja_variants.tsv"
+        depths = f"output/{sample}/freyja/{sample}_freyja.depths"
+        result = f"output/{sample}/freyja/{sample}_freyja_result.tsv"
+        if not (os.path.isfile(variants) and os.path.isfile(depths)):
+            continue
+        if os.path.isfile(result) and os.path.getmtime(result) >= os.path.getmtime(variants):
+            continue
+        samples.append(sample)
+    return samples
+
+
+def batch_demix(timing_path):
+    global BARCODES, LINEAGE_MAP, DEMIX_PARAMS
+    with open("config.json", "r") as file:
+        config = json.load(file)
+    params = config["params"]
+    if params["minimum_coverage_depth"] != 0:
+        # the depth cutoff collapses the barcodes for each sample, leave these to freyja demix
+        msg = "batch demix skipped: minimum_coverage_depth is set, running freyja demix per sample \n"
+        sys.stderr.write(msg)
+        return
+    samples = samples_to_demix(config["sample_registry"])
+    if len(samples) == 0:
+        return
+    os.makedirs("tmp", exist_ok=True)
+
+    try:
+        from freyja.sample_deconv import (build_mix_and_depth_arrays, buildLineageMap, map_to_constellation,
+                                          reindex_dfs, solve_demixing_problem)
+    except ImportError as e:
+        msg = f"batch demix skipped: freyja is not importable ({e}), running freyja demix per sample \n"
+        sys.stderr.write(msg)
+        return
+    version = freyja_version()
+    unsupported = unsupported_options(solve_demixing_problem, SOLVER_OPTIONS)
+    if len(unsupported) != 0:
+        msg = (f"batch demix skipped: solve_demixing_problem of freyja {version} does not take {unsupported}, "
+            f"running freyja demix per sample \n")
+        sys.stderr.write(msg)
+        return
+    start = time.time()
+    BARCODES = load_barcodes(config["barcodes_path"], params["confirmedonly"] == True)
+    LINEAGE_MAP = buildLineageMap(config["curated_lineages_path"])
+    DEMIX_PARAMS = {"eps": params["minimum_lineage_abundance"], "covcut": params["coverage_estimate"],
+                    "adapt": config["demix_adapt"], "a_eps": config["demix_a_eps"]}
+    load_time = time.time() - start
+
+    # the mapped barcodes are shared, but each solve works on its own float copy, size the pool to fit in memory
+    barcodes_mb = BARCODES.shape[0] * BARCODES.shape[1] * 8 / (1024 * 1024)
+    worker_mb = 1024 + 2 * barcodes_mb
+    memory_workers = int(config.get("memory_mb", 16000) // worker_mb)
+    workers = max(1, min(int(config["cores"]), memory_workers, len(samples)))
+
+    start = time.time()
+    results = []
+    state = JobState(read=False)
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        for sample, status, seconds, error, sols_df in pool.imap_unordered(demix_sample, samples):
+            if sols_df is not None:
+                add_sample(sols_df.name, sols_df.to_dict(), f"output/{sample}/{sample}_aggregated_result.tsv")
+                state.record("batch_demix", sample, [f"output/{sample}/freyja/{sample}_freyja_result.tsv",
+                                                     f"output/{sample}/{sample}_aggregated_result.tsv"])
+            results.append((sample, status, seconds, error))
+    solve_time = time.time() - start
+
+    timing_df = pd.DataFrame(results, columns=["sample", "status", "seconds", "error"])
+    timing_df.to_csv(timing_path, sep="\t", index=False, float_format="%.2f")
+    failed = timing_df[timing_df["status"] != "complete"]["sample"].tolist()
+    msg = (f"batch demix: freyja {version}, {len(samples)} samples with {workers} workers, loading barcodes {load_time:.1f}s, "
+        f"solving {solve_time:.1f}s, per sample mean {timing_df['seconds'].mean():.1f}s max {timing_df['seconds'].max():.1f}s \n")
+    sys.stderr.write(msg)
+    if len(failed) != 0:
+        msg = f"batch demix failed for {failed}, running freyja demix for these samples \n"
+        sys.stderr.write(msg)
+
+
+@click.command()
+@click.argument("timing_path")
+def cli(timing_path):
+    batch_demix(timing_path)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,131 @@
+import click
+import json
+import numpy as np
+import os
+import pandas as pd
+import plotly.graph_objects as go
+import sys
+import time
+
+from freyja_depths import read_depths
+from job_state import JobState
+from time_series_plots import colorblind_palette
+
+#
+# Multi-sample interactive coverage panel for the HTML report.
+# Every output/{sample}/freyja/{sample}_freyja.depths written by
+# freyja variants (reference, position, base, depth per genome position) is
+# loaded into one samples x positions depth matrix. Each ~30 kb track is
+# downsampled to a few hundred points with Largest-Triangle-Three-Buckets,
+# which keeps the peaks and dropouts a plain stride would skip, and all
+# tracks are drawn as one Plotly figure instead of one PNG per sample.
+# LTTB walks the buckets in order, each step is vectorized over the samples.
+# The matrix holds the depths as int32, 0.6 GB for 5k samples, and only the
+# bucket being scored is cast to float.
+#
+
+
+def load_depth_matrix(samples):
+    # samples x genome positions, positions missing from a depths file have no coverage
+    tracks = {}
+    state = JobState()
+    for sample in samples:
+        depths_path = f"output/{sample}/freyja/{sample}_freyja.depths"
+        if not state.exists(depths_path):
+            continue
+        try:
+            tracks[sample] = read_depths(depths_path)
+        except (OSError, ValueError, pd.errors.ParserError) as e:
+            msg = f"could not read the depths of {sample}, left out of the coverage panel: {e} \n"
+            sys.stderr.write(msg)
+    genome_length = max((positions.max() for positions, depths in tracks.values() if len(positions)), default=0)
+    matrix = np.zeros((len(tracks), genome_length), dtype=np.int32)
+    for row, (positions, depths) in enumerate(tracks.values()):
+        matrix[row, positions - 1] = depths
+    return list(tracks), matrix
+
+
+def lttb(x, matrix, n_out):
+    # column indices of the n_out points kept of every row, first and last point always kept
+    n_samples, n = matrix.shape
+    if n_out >= n or n_out < 3:
+        return np.tile(np.arange(n), (n_samples, 1))
+    # n_out - 2 buckets between the first and the last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty((n_samples, n_out), dtype=np.int64)
+    selected[:, 0] = 0
+    selected[:, -1] = n - 1
+    rows = np.arange(n_samples)
+    previous = np.zeros(n_samples, dtype=np.int64)
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # average point of the next bucket, the last bucket looks ahead to the last point
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = matrix[:, end:next_end].mean(axis=1, dtype=np.float64)
+        previous_x = x[previous][:, None]
+        previous_y = matrix[rows, previous][:, None].astype(np.float64)
+        bucket_y = matrix[:, start:end].astype(np.float64)
+        # keep the point of the bucket spanning the largest triangle with the previous kept point and the next average
+        area = np.abs((previous_x - next_x) * (bucket_y - previous_y)
+                      - (previous_x - x[start:end][None, :]) * (next_y[:, None] - previous_y))
+        previous = start + area.argmax(axis=1)
+        selected[:, i + 1] = previous
+    return selected
+
+
+def plot_coverage_panel(samples, matrix, points, out):
+    positions = np.arange(1, matrix.shape[1] + 1)
+    selected = lttb(positions, matrix, points)
+    fig = go.Figure()
+    for row, sample in enumerate(samples):
+        fig.add_trace(go.Scattergl(
+            x=positions[selected[row]].astype(np.int32),
+            y=matrix[row, selected[row]].astype(np.int32),
+            name=sample,
+            mode='lines',
+            line=dict(width=1, color=colorblind_palette[row % len(colorblind_palette)]),
+            hovertemplate='<b>%{data.name}</b><br>Position %{x}<br>Depth %{y}<extra></extra>',
+        ))
+
+    fig.update_layout(
+        title='Sequencing Depth by Sample',
+        title_font_size=24,
+        xaxis_title='Position (Wuhan-Hu-1)',
+        xaxis_title_font_size=18,
+        xaxis=dict(tickfont_size=16),
+        yaxis_title='Depth',
+        yaxis_title_font_size=18,
+        yaxis=dict(tickfont_size=16),
+        legend_title='Sample',
+        legend_title_font_size=16,
+        legend_font_size=14,
+        hoverlabel=dict(font_size=16, font_family="Roboto"),
+        # amplicon dropouts are easier to see on a log scale
+        updatemenus=[dict(type='buttons', direction='right', x=1, y=1.08, buttons=[
+            dict(label='Linear', method='relayout', args=[{'yaxis.type': 'linear'}]),
+            dict(label='Log', method='relayout', args=[{'yaxis.type': 'log'}]),
+        ])],
+        height=600,
+    )
+    fig.write_html(out, include_plotlyjs=False)  # This plot will not work outside of the report
+
+
+@click.command()
+@click.argument("out")
+@click.option("--config", "config_path", default="config.json", show_default=True, help="job config holding the sample registry")
+@click.option("--points", default=400, show_default=True, help="points kept of every coverage track")
+def cli(out, config_path, points):
+    with open(config_path, "r") as fh:
+        config = json.load(fh)
+    start = time.time()
+    samples, matrix = load_depth_matrix(list(config["sample_registry"]))
+    load_time = time.time() - start
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    plot_coverage_panel(samples, matrix, points, out)
+    msg = (f"coverage panel: {len(samples)} samples x {matrix.shape[1]} positions loaded in {load_time:.1f}s, "
+        f"{points} points per track, {os.path.getsize(out) / 1e6:.2f} MB in {time.time() - start:.1f}s \n")
+    sys.stderr.write(msg)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,167 @@
+import click
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+from fastq_preflight import PRIMER_OFFSETS, PRIMER_PREFIX, fastq_chunks, load_primer_prefixes
+
+#
+# Depth normalization of the reads of one sample before the assembly.
+# Every read (pair) is given the amplicon of the primer it starts with, from
+# the sample's primer scheme. The reads are streamed once, in batches: each
+# amplicon keeps a random sample of the target depth out of its first
+# WINDOW_FACTOR times the target depth reads (reservoir sampling with a random
+# generator seeded by the seed, so the same reads and seed keep the same reads).
+# Once an amplicon has seen its window its reads are only looked up and
+# skipped. Reading stops once every amplicon has seen its window, or after
+# SCAN_FACTOR times the target depth times the number of amplicons reads, so
+# the time spent here is bounded by the target depth and not by the depth of
+# the library; only amplicons with a tiny share of a very deep library are
+# left with fewer reads than a scan of the whole file would give them, and
+# --scan-factor 0 reads the whole file. Both mates of a pair are kept or
+# dropped together. Reads that start with no primer share one bin, capped at
+# the target depth times the number of amplicons.
+#
+
+REPORT_COLUMNS = ["amplicon", "reads_seen", "kept"]
+UNASSIGNED = "no_primer"
+
+# reads of an amplicon the sample is drawn from, as a multiple of the target depth
+WINDOW_FACTOR = 4
+# reads scanned at most, as a multiple of the target depth times the number of amplicons
+SCAN_FACTOR = 20
+BATCH_RECORDS = 16384
+
+
+def record_batches(path, batch_records=BATCH_RECORDS):
+    # lines of batch_records records at a time of a FASTQ, gzipped or plain, fewer in the last batch
+    with open(path, "rb") as raw:
+        gzipped = raw.read(2) == b"\x1f\x8b"
+        raw.seek(0)
+        pending = []
+        rest = b""
+        for chunk in fastq_chunks(raw, gzipped):
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            pending += lines
+            while len(pending) >= 4 * batch_records:
+                yield pending[:4 * batch_records]
+                del pending[:4 * batch_records]
+        if rest:
+            pending.append(rest)
+        complete = len(pending) - len(pending) % 4
+        if complete:
+            yield pending[:complete]
+
+
+def paired_batches(paths):
+    # batches of the mates side by side, R1 and R2 must hold the same number of reads
+    readers = [record_batches(path) for path in paths]
+    while True:
+        batches = [next(reader, None) for reader in readers]
+        if all(batch is None for batch in batches):
+            return
+        if None in batches or len(set(map(len, batches))) != 1:
+            msg = f"downsampling: {' and '.join(paths)} differ in the number of reads \n"
+            sys.stderr.write(msg)
+            sys.exit(1)
+        yield batches
+
+
+def batch_amplicons(batches, prefixes):
+    # amplicon of the first primer found at the start of a mate, for every read (pair) of a batch
+    amplicons = [prefixes.get(seq[:PRIMER_PREFIX]) for seq in batches[0][1::4]]
+    for i, amplicon in enumerate(amplicons):
+        if amplicon is not None:
+            continue
+        for batch in batches:
+            seq = batch[4 * i + 1]
+            for offset in range(PRIMER_OFFSETS):
+                amplicon = prefixes.get(seq[offset:offset + PRIMER_PREFIX])
+                if amplicon is not None:
+                    break
+            if amplicon is not None:
+                break
+        amplicons[i] = amplicon if amplicon is not None else UNASSIGNED
+    return amplicons
+
+
+def downsample(reads, outputs, report, primers, primer_version, schemes_dir, depth, seed, scan_factor=SCAN_FACTOR):
+    start = time.time()
+    prefixes = load_primer_prefixes(schemes_dir, primers, primer_version)
+    if not prefixes:
+        msg = f"downsampling: primer scheme {primers} {primer_version} is not in {schemes_dir} \n"
+        sys.stderr.write(msg)
+        sys.exit(1)
+    caps = {amplicon: depth for amplicon in sorted(set(prefixes.values()))}
+    max_reads = scan_factor * depth * len(caps)
+    caps[UNASSIGNED] = depth * len(caps)
+    draw = random.Random(seed).random
+    seen = Counter()
+    # amplicon: the mates of each read (pair) kept, as FASTQ text
+    kept = {amplicon: [] for amplicon in caps}
+    # amplicons that have seen their window, their reads are skipped
+    closed = set()
+    scanned = 0
+    for batches in paired_batches(reads):
+        amplicons = batch_amplicons(batches, prefixes)
+        # reads of the amplicons still sampling, the others are skipped here
+        for i in [i for i, amplicon in enumerate(amplicons) if amplicon not in closed]:
+            amplicon = amplicons[i]
+            if amplicon in closed:
+                continue
+            n = seen[amplicon]
+            seen[amplicon] = n + 1
+            if n + 1 >= WINDOW_FACTOR * caps[amplicon]:
+                closed.add(amplicon)
+            if n < caps[amplicon]:
+                slot = n
+                kept[amplicon].append(None)
+            else:
+                slot = int(draw() * (n + 1))
+                if slot >= caps[amplicon]:
+                    continue
+            kept[amplicon][slot] = [b"\n".join(batch[4 * i:4 * i + 4]) + b"\n" for batch in batches]
+        scanned += len(amplicons)
+        if len(closed) == len(caps) or (max_reads and scanned >= max_reads):
+            break
+    fhs = [open(output, "wb") for output in outputs]
+    try:
+        for amplicon in caps:
+            for mates in kept[amplicon]:
+                for fh, record in zip(fhs, mates):
+                    fh.write(record)
+    finally:
+        for fh in fhs:
+            fh.close()
+    os.makedirs(os.path.dirname(report) or ".", exist_ok=True)
+    with open(report, "w") as fh:
+        fh.write("\t".join(REPORT_COLUMNS) + "\n")
+        for amplicon in sorted(seen):
+            fh.write(f"{amplicon}\t{seen[amplicon]}\t{len(kept[amplicon])}\n")
+    msg = (f"downsampling: kept {sum(map(len, kept.values()))} of {scanned} reads scanned to depth {depth} over "
+        f"{len(seen)} amplicons, {len(closed)} full, in {time.time() - start:.1f}s \n")
+    sys.stderr.write(msg)
+
+
+@click.command()
+@click.option("--reads", multiple=True, required=True, help="FASTQ of the sample, R1 then R2 for paired reads")
+@click.option("--output", "outputs", multiple=True, required=True, help="FASTQ written for each --reads")
+@click.option("--report", required=True, help="TSV of the reads seen and the reads kept for each amplicon")
+@click.option("--primers", required=True, help="primer scheme of the sample")
+@click.option("--primer-version", required=True, help="version of the primer scheme")
+@click.option("--schemes-dir", required=True, help="primer schemes as <primers>/<version>/*.primer.bed and *.reference.fasta")
+@click.option("--depth", default=2000, show_default=True, help="reads kept for each amplicon")
+@click.option("--seed", default=0, show_default=True, help="seed of the reads kept")
+@click.option("--scan-factor", default=SCAN_FACTOR, show_default=True, help="reads scanned at most as a multiple of depth times amplicons, 0 for all")
+def cli(reads, outputs, report, primers, primer_version, schemes_dir, depth, seed, scan_factor):
+    if len(reads) != len(outputs):
+        msg = "downsampling: give one --output for each --reads \n"
+        sys.stderr.write(msg)
+        sys.exit(1)
+    downsample(list(reads), list(outputs), report, primers, primer_version, schemes_dir, depth, seed, scan_factor)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,290 @@
+import click
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+import zlib
+import pandas as pd
+
+#
+# Pre-flight check of the input reads before any assembly.
+# The first reads of every FASTQ (gzipped or plain) are streamed by a pool of
+# worker processes: the gzip stream and the FASTQ records are checked, the read
+# lengths are measured and the number of reads in the file is estimated from
+# the bytes the checked reads took. For amplicon sequencing most reads start
+# with a primer of the sample's primer scheme; where the scheme files are
+# available (config["primer_schemes_dir"], laid out like the ARTIC
+# primer-schemes repository as <primers>/<version>/*.primer.bed and
+# *.reference.fasta) the share of reads starting with a primer is measured.
+# iVar trimming drops reads that start with no primer, so a sample with hardly
+# any primer starts, not amplicon sequencing or primers trimmed already, ends
+# up without an assembly and fails the check.
+# Samples whose reads can not be assembled fail the check and the wrapper
+# drops them before snakemake runs.
+#
+
+PREFLIGHT_COLUMNS = ["sample", "status", "reason", "reads_checked", "estimated_reads", "mean_read_length",
+    "min_read_length", "max_read_length", "primer_concordance"]
+
+# bases of a primer matched at the start of a read
+PRIMER_PREFIX = 12
+# reads may carry a few bases before the primer
+PRIMER_OFFSETS = 4
+# below this share of primer starts the sample fails, config["preflight_min_primer_concordance"]
+MIN_PRIMER_CONCORDANCE = 0.01
+# below this share of primer starts the sample gets a warning
+PRIMER_WARN_CONCORDANCE = 0.05
+# share of the read pairs checked whose names must match
+MIN_PAIRED_NAMES = 0.9
+
+READ_CHUNK_BYTES = 1024 * 1024
+GZIP_CHUNK_BYTES = 16 * 1024
+SEQUENCE_BYTES = b"ACGTNURYKMSWBDHVacgtnurykmswbdhv."
+COMPLEMENT = str.maketrans("ACGTacgt", "TGCAtgca")
+
+# primer prefixes of each scheme, loaded before the worker processes fork
+primer_prefixes = {}
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def read_reference(path):
+    with open(path, "r") as fh:
+        return "".join(line.strip() for line in fh if not line.startswith(">")).upper()
+
+
+def primer_amplicon(primer_name):
+    # nCoV-2019_1_LEFT_alt0 -> nCoV-2019_1
+    return primer_name.split("_LEFT")[0].split("_RIGHT")[0]
+
+
+def load_primer_prefixes(schemes_dir, primers, primer_version):
+    # start of every primer as it shows at the start of a read: its amplicon,
+    # None when the scheme is not in schemes_dir
+    scheme_dir = os.path.join(schemes_dir, str(primers), str(primer_version))
+    beds = sorted(glob.glob(os.path.join(scheme_dir, "*.primer.bed")))
+    references = sorted(glob.glob(os.path.join(scheme_dir, "*.reference.fasta")))
+    if not beds or not references:
+        return None
+    reference = read_reference(references[0])
+    prefixes = {}
+    with open(beds[0], "r") as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 4 or line.startswith("#"):
+                continue
+            seq = reference[int(fields[1]):int(fields[2])]
+            # older schemes have no strand column, the primer name tells LEFT from RIGHT
+            reverse = fields[5] == "-" if len(fields) > 5 else "RIGHT" in fields[3]
+            if reverse:
+                seq = reverse_complement(seq)
+            if len(seq) >= PRIMER_PREFIX:
+                prefixes[seq[:PRIMER_PREFIX].encode()] = primer_amplicon(fields[3])
+    return prefixes
+
+
+def fastq_chunks(raw, gzipped):
+    # bytes of a FASTQ, decompressed when gzipped
+    if not gzipped:
+        yield from iter(lambda: raw.read(READ_CHUNK_BYTES), b"")
+        return
+    # zlib checks the crc and length at the end of every gzip member, the file is read in
+    # small chunks so raw.tell() is close to the compressed bytes used
+    decompressor = None
+    for chunk in iter(lambda: raw.read(GZIP_CHUNK_BYTES), b""):
+        while chunk:
+            if decompressor is None or decompressor.eof:
+                decompressor = zlib.decompressobj(31)
+            yield decompressor.decompress(chunk)
+            # the next member of a multi member gzip (bgzip) starts in the same chunk
+            chunk = decompressor.unused_data if decompressor.eof else b""
+    if decompressor is None or not decompressor.eof:
+        raise EOFError("compressed file ended before the end of the gzip stream")
+
+
+def read_records(chunks, n_reads):
+    # lines of the first n_reads records, fewer at the end of the file
+    data = b""
+    newlines = 0
+    for chunk in chunks:
+        data += chunk
+        newlines += chunk.count(b"\n")
+        if newlines >= 4 * n_reads:
+            break
+    lines = data.split(b"\n")[:4 * n_reads]
+    # a last record without its newline
+    if lines and lines[-1] == b"":
+        lines.pop()
+    return lines, newlines
+
+
+def check_records(lines):
+    # reason the records are not FASTQ, None when they are
+    headers, seqs, pluses, quals = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+    if not all(header.startswith(b"@") for header in headers):
+        return "FASTQ header does not start with @"
+    if len(lines) % 4 != 0:
+        return "FASTQ record cut short"
+    if not all(plus.startswith(b"+") for plus in pluses):
+        return "FASTQ separator line does not start with +"
+    if list(map(len, seqs)) != list(map(len, quals)):
+        return "sequence and quality of a read differ in length"
+    if b"".join(seqs).translate(None, SEQUENCE_BYTES):
+        return "sequence with characters other than bases"
+    return None
+
+
+def sniff_read_file(path, n_reads, full_gzip_check):
+    # checks the first n_reads reads of a FASTQ, with full_gzip_check the whole gzip stream is read to its checksum
+    result = {"path": path, "error": None, "reads": 0, "lengths": [], "names": [], "starts": [], "estimated_reads": 0}
+    if path is None or not os.path.isfile(path):
+        result["error"] = "read file missing"
+        return result
+    size = os.path.getsize(path)
+    if size == 0:
+        result["error"] = "read file is empty"
+        return result
+    try:
+        with open(path, "rb") as raw:
+            # gzip is told by the magic bytes, not the file name
+            gzipped = raw.read(2) == b"\x1f\x8b"
+            raw.seek(0)
+            chunks = fastq_chunks(raw, gzipped)
+            lines, newlines = read_records(chunks, n_reads)
+            error = check_records(lines)
+            if error is not None:
+                result["error"] = error
+                return result
+            reads = len(lines) // 4
+            result["reads"] = reads
+            result["lengths"] = list(map(len, lines[1::4]))
+            # read names without the comment and the /1 /2 mate suffix
+            result["names"] = [header[1:].split()[0].removesuffix(b"/1").removesuffix(b"/2") if header[1:].split() else b""
+                for header in lines[0::4]]
+            result["starts"] = [seq[:PRIMER_PREFIX + PRIMER_OFFSETS] for seq in lines[1::4]]
+            if reads < n_reads:
+                # the whole file was read
+                result["estimated_reads"] = reads
+            elif full_gzip_check and gzipped:
+                # every record is counted on the way to the gzip checksums
+                for chunk in chunks:
+                    newlines += chunk.count(b"\n")
+                result["estimated_reads"] = newlines // 4
+            else:
+                # the bytes of the file the reads read so far took, compressed for gzip
+                if gzipped:
+                    result["estimated_reads"] = int(newlines // 4 * size / raw.tell())
+                else:
+                    result["estimated_reads"] = int(reads * size / (len(b"\n".join(lines)) + 1))
+    except (EOFError, zlib.error) as e:
+        result["error"] = f"gzip stream is corrupt: {e}"
+    return result
+
+
+def primer_concordance(starts, prefixes):
+    # share of reads starting with a primer, a few bases into the read at most
+    if not starts:
+        return 0.0
+    hits = 0
+    for start in starts:
+        if any(start[offset:offset + PRIMER_PREFIX] in prefixes for offset in range(PRIMER_OFFSETS)):
+            hits += 1
+    return hits / len(starts)
+
+
+def preflight_sample(task):
+    sample, lib, n_reads, full_gzip_check, min_read_length, min_primer_concordance = task
+    record = {"sample": sample, "status": "pass", "reason": ""}
+    results = [sniff_read_file(path, n_reads, full_gzip_check) for path in lib.get("sources", lib["reads"])]
+    errors = [f"{os.path.basename(str(result['path']))}: {result['error']}" for result in results if result["error"]]
+    if errors:
+        record.update(status="fail", reason="; ".join(errors))
+        return record
+    lengths = [length for result in results for length in result["lengths"]]
+    record["reads_checked"] = results[0]["reads"]
+    record["estimated_reads"] = results[0]["estimated_reads"]
+    if lengths:
+        record["mean_read_length"] = round(sum(lengths) / len(lengths), 1)
+        record["min_read_length"] = min(lengths)
+        record["max_read_length"] = max(lengths)
+    warnings = []
+    if not lengths:
+        record.update(status="fail", reason="no reads")
+        return record
+    if record["mean_read_length"] < min_read_length:
+        record.update(status="fail", reason=f"mean read length {record['mean_read_length']} is below {min_read_length}")
+        return record
+    if len(results) == 2:
+        r1, r2 = results
+        if r1["reads"] != r2["reads"]:
+            record.update(status="fail", reason=f"R1 and R2 differ in reads ({r1['reads']} and {r2['reads']} checked)")
+            return record
+        if full_gzip_check and r1["estimated_reads"] != r2["estimated_reads"]:
+            record.update(status="fail", reason=f"R1 and R2 differ in reads ({r1['estimated_reads']} and {r2['estimated_reads']})")
+            return record
+        matching = sum(name1 == name2 for name1, name2 in zip(r1["names"], r2["names"]))
+        if matching < MIN_PAIRED_NAMES * r1["reads"]:
+            record.update(status="fail", reason=f"read names of R1 and R2 do not match ({matching} of {r1['reads']} pairs)")
+            return record
+    prefixes = primer_prefixes.get((lib.get("primers"), lib.get("primer_version")))
+    if prefixes:
+        concordance = primer_concordance([start for result in results for start in result["starts"]], prefixes)
+        record["primer_concordance"] = round(concordance, 4)
+        if concordance < min_primer_concordance:
+            record.update(status="fail", reason=f"{100 * concordance:.1f}% of reads start with a {lib.get('primers')} {lib.get('primer_version')} primer: not amplicon sequencing, or the primers are trimmed already")
+            return record
+        if concordance < PRIMER_WARN_CONCORDANCE:
+            warnings.append(f"{100 * concordance:.1f}% of reads start with a {lib.get('primers')} {lib.get('primer_version')} primer, the reads may be primer trimmed already or not amplicon sequencing")
+    if warnings:
+        record.update(status="warn", reason="; ".join(warnings))
+    return record
+
+
+def preflight(sample_registry, n_reads=10000, workers=4, full_gzip_check=False, primer_schemes_dir=None,
+        min_read_length=30, min_primer_concordance=MIN_PRIMER_CONCORDANCE):
+    # one record for each sample of the registry, status pass, warn or fail
+    start = time.time()
+    if primer_schemes_dir:
+        for lib in sample_registry.values():
+            scheme = (lib.get("primers"), lib.get("primer_version"))
+            if scheme not in primer_prefixes:
+                primer_prefixes[scheme] = load_primer_prefixes(primer_schemes_dir, *scheme)
+                if not primer_prefixes[scheme]:
+                    msg = f"preflight: primer scheme {scheme[0]} {scheme[1]} is not in {primer_schemes_dir}, its samples are not checked for primer starts \n"
+                    sys.stderr.write(msg)
+    tasks = [(sample, lib, n_reads, full_gzip_check, min_read_length, min_primer_concordance)
+        for sample, lib in sample_registry.items() if lib.get("reads")]
+    if len(tasks) > 1 and workers > 1:
+        with multiprocessing.get_context("fork").Pool(min(workers, len(tasks))) as pool:
+            records = list(pool.imap(preflight_sample, tasks, chunksize=max(1, len(tasks) // (8 * workers))))
+    else:
+        records = [preflight_sample(task) for task in tasks]
+    preflight_df = pd.DataFrame.from_records(records, columns=PREFLIGHT_COLUMNS)
+    counts = ["reads_checked", "estimated_reads", "min_read_length", "max_read_length"]
+    preflight_df[counts] = preflight_df[counts].astype("Int64")
+    msg = (f"preflight: {len(preflight_df)} samples in {time.time() - start:.1f}s, "
+        f"{(preflight_df['status'] == 'pass').sum()} pass, {(preflight_df['status'] == 'warn').sum()} warn, "
+        f"{(preflight_df['status'] == 'fail').sum()} fail \n")
+    sys.stderr.write(msg)
+    return preflight_df
+
+
+@click.command()
+@click.argument("path")
+@click.option("--config", "config_path", default="config.json", show_default=True, help="job config holding the sample registry")
+@click.option("--reads", "n_reads", default=10000, show_default=True, help="reads checked at the start of each FASTQ")
+@click.option("--workers", default=4, show_default=True, help="samples checked at once")
+@click.option("--full-gzip-check", is_flag=True, help="read every gzip stream to its checksum")
+def cli(path, config_path, n_reads, workers, full_gzip_check):
+    with open(config_path, "r") as fh:
+        config = json.load(fh)
+    preflight_df = preflight(config["sample_registry"], n_reads, workers, full_gzip_check, config.get("primer_schemes_dir"),
+        config.get("preflight_min_read_length", 30), config.get("preflight_min_primer_concordance", MIN_PRIMER_CONCORDANCE))
+    preflight_df.to_csv(path, sep="\t", index=False)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,86 @@
+import fcntl
+import os
+
+#
+# In process replacement for freyja aggregate.
+# Each demix result is added to the cohort output/freyja_result.tsv as soon
+# as it is written, and the same row is written as the sample's own
+# {sample}_aggregated_result.tsv, so there is no freyja aggregate process per
+# sample and no second aggregate over the whole cohort at the end.
+# The rows are the text of the demix result, in the same layout as
+# freyja aggregate: one row per sample named by its variants file.
+# The cohort table holds one row per sample: the wrapper rebuilds it from the
+# per sample rows before the samples run, so a resumed or rerun job starts
+# from the samples already done, and a sample added again replaces its row.
+#
+
+AGGREGATE_COLUMNS = ["summarized", "lineages", "abundances", "resid", "coverage"]
+AGGREGATE_HEADER = "\t" + "\t".join(AGGREGATE_COLUMNS) + "\n"
+COHORT_PATH = "output/freyja_result.tsv"
+# the cohort table is replaced by a rename, so the writers lock a file next to it instead
+COHORT_LOCK = "tmp/freyja_result.tsv.lock"
+
+
+def read_result(result_path):
+    # freyja demix result: the variants file name as header then one field per line
+    with open(result_path) as fh:
+        name = fh.readline().rstrip("\n").split("\t")[-1]
+        fields = dict(line.rstrip("\n").split("\t", 1) for line in fh if "\t" in line)
+    return name, fields
+
+
+def format_row(name, fields):
+    return "\t".join([name] + [str(fields.get(column, "")) for column in AGGREGATE_COLUMNS]) + "\n"
+
+
+def write_cohort(rows, cohort_path):
+    # rows by name, written to a temporary file that replaces the cohort table at once
+    tmp_path = f"{cohort_path}.tmp"
+    with open(tmp_path, "w") as fh:
+        fh.write(AGGREGATE_HEADER + "".join(rows.values()))
+    os.replace(tmp_path, cohort_path)
+
+
+def read_rows(path):
+    # rows of an aggregate table by sample name, the header line is skipped
+    with open(path) as fh:
+        fh.readline()
+        return {line.split("\t", 1)[0]: line if line.endswith("\n") else line + "\n" for line in fh if line.strip()}
+
+
+def rebuild_cohort(sample_aggregate_paths, cohort_path=COHORT_PATH):
+    # the cohort table from the per sample rows that exist, no table without any
+    rows = {}
+    for path in sample_aggregate_paths:
+        if os.path.exists(path):
+            rows.update(read_rows(path))
+    if rows:
+        write_cohort(rows, cohort_path)
+    elif os.path.exists(cohort_path):
+        os.remove(cohort_path)
+    return len(rows)
+
+
+def add_sample(name, fields, sample_aggregate_path, cohort_path=COHORT_PATH):
+    row = format_row(name, fields)
+    with open(sample_aggregate_path, "w") as fh:
+        fh.write(AGGREGATE_HEADER + row)
+    # demix results land from the batch and from snakemake jobs, lock while adding
+    os.makedirs(os.path.dirname(COHORT_LOCK), exist_ok=True)
+    with open(COHORT_LOCK, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(cohort_path) and os.path.getsize(cohort_path) != 0:
+            with open(cohort_path) as fh:
+                cohort = fh.read()
+            if cohort.startswith(name + "\t") or f"\n{name}\t" in cohort:
+                # a sample solved again replaces its row
+                rows = read_rows(cohort_path)
+                rows[name] = row
+                write_cohort(rows, cohort_path)
+            else:
+                with open(cohort_path, "a") as fh:
+                    fh.write(row)
+        else:
+            write_cohort({name: row}, cohort_path)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return
@@ -0,0 +1,20 @@
+import numpy as np
+import os
+import pandas as pd
+
+#
+# Reader of the freyja depths files, output/{sample}/freyja/{sample}_freyja.depths
+# written by freyja variants with one line per genome position: reference,
+# position, base, depth. Shared by the job stats (prep_results.py) and the
+# coverage panel (coverage_panel.py). Depths are read as int32, a genome
+# position is never covered by more than 2^31 reads.
+#
+
+
+def read_depths(depths_path):
+    # position and depth columns of a freyja depths file, an empty file has no positions
+    if os.path.getsize(depths_path) == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    depths_df = pd.read_csv(depths_path, sep="\t", header=None, usecols=[1, 3], names=["position", "depth"],
+                            dtype={"position": np.int32, "depth": np.int32})
+    return depths_df["position"].to_numpy(), depths_df["depth"].to_numpy()
@@ -0,0 +1,211 @@
+import ast
+import click
+import heapq
+import numpy as np
+import pandas as pd
+import sys
+import time
+import yaml
+
+#
+# Long frames from the aggregated Freyja results (output/freyja_result.tsv)
+# shared by the sample level and time series plots.
+# The one row per sample table is turned into (sample, lineage, abundance)
+# and (sample, variant, abundance) with vectorized split/explode instead of
+# a python loop over the rows, and the summarized column is parsed without
+# eval(). Sample, lineage and variant names are categoricals so large cohorts
+# hold each name once and the codes can be used as integer ids.
+# For large cohorts the lineages can be rolled up the lineages.yml hierarchy
+# into at most top_n clades plus an "Other" bucket, so the number of plot
+# traces stays bounded however many lineages the cohort holds.
+#
+
+OTHER = "Other"
+
+RESULT_COLUMNS = ["sample", "summarized", "lineages", "abundances", "resid", "coverage"]
+
+# one ('name', abundance) tuple of the summarized column, numpy 2 writes the abundance as np.float64(...)
+SUMMARIZED_PATTERN = r"""\((['"])(.*?)\1,\s*(?:np\.float64\()?([-+0-9.eE]+)\)?\)"""
+
+
+def read_freyja_results(freyja_results):
+    df = pd.read_csv(freyja_results, sep="\t")
+    df.columns = RESULT_COLUMNS
+    # chop off the file name and extension
+    df["sample"] = df["sample"].str.replace("_freyja_variants.tsv", "", regex=False)
+    return df
+
+
+def get_lineage_info(df, min_abundance=0.02):
+    # explode the space separated lineages and abundances together, one row per lineage
+    lineage_df = pd.DataFrame({
+        "sample": df["sample"],
+        "lineage": df["lineages"].fillna("").str.split(),
+        "abundance": df["abundances"].fillna("").str.split(),
+    }).explode(["lineage", "abundance"], ignore_index=True)
+    lineage_df = lineage_df.dropna(subset=["lineage"])
+    lineage_df["abundance"] = lineage_df["abundance"].astype(float)
+    # drop lineage from plotting if it is less than 2%
+    lineage_df = lineage_df[lineage_df["abundance"] >= min_abundance]
+    lineage_df = lineage_df.astype({"sample": "category", "lineage": "category"})
+    return lineage_df.reset_index(drop=True)
+
+
+def parse_summarized(summarized):
+    # literal parse of a single summarized value the pattern does not cover
+    try:
+        return [(str(name), float(abundance)) for name, abundance in ast.literal_eval(summarized)]
+    except (ValueError, SyntaxError, TypeError):
+        return []
+
+
+def get_variant_info(df):
+    # every ('name', abundance) tuple of the summarized column, one row per variant
+    summarized = df["summarized"].fillna("").astype(str)
+    found = summarized.str.findall(SUMMARIZED_PATTERN)
+    # values the pattern does not cover go through the literal parser
+    unmatched = (found.str.len() == 0) & (summarized.str.len() > 2)
+    if unmatched.any():
+        found[unmatched] = summarized[unmatched].map(lambda value: [("", name, abundance) for name, abundance in parse_summarized(value)])
+    exploded = pd.DataFrame({"sample": df["sample"], "match": found}).explode("match", ignore_index=True)
+    exploded = exploded.dropna(subset=["match"])
+    matches = pd.DataFrame(exploded["match"].tolist(), columns=["quote", "variant", "abundance"])
+    variants_df = pd.DataFrame({
+        "sample": exploded["sample"].to_numpy(),
+        "variant": matches["variant"].to_numpy(),
+        "abundance": matches["abundance"].astype(float).to_numpy(),
+    })
+    variants_df = variants_df.astype({"sample": "category", "variant": "category"})
+    return variants_df
+
+
+def load_lineage_parents(lineages_path):
+    # child -> parent clade from the lineages.yml hierarchy used by freyja plot
+    try:
+        with open(lineages_path) as fh:
+            lineages_yml = yaml.safe_load(fh)
+    except (OSError, yaml.YAMLError) as e:
+        msg = f"could not read the lineage hierarchy {lineages_path}, lineages are not rolled up: {e} \n"
+        sys.stderr.write(msg)
+        return {}
+    if not isinstance(lineages_yml, list):
+        msg = f"{lineages_path} is not a list of lineages, lineages are not rolled up \n"
+        sys.stderr.write(msg)
+        return {}
+    entries = [entry for entry in lineages_yml if isinstance(entry, dict) and "name" in entry]
+    parents = {entry["name"]: entry["parent"] for entry in entries if entry.get("parent")}
+    # without a parent field the nearest ancestor is the smallest clade listing the lineage as a child
+    for entry in sorted(entries, key=lambda entry: len(entry.get("children") or [])):
+        for child in entry.get("children") or []:
+            if child != entry["name"]:
+                parents.setdefault(child, entry["name"])
+    return parents
+
+
+def get_lineage_groups(totals, parents, top_n):
+    # merge the least abundant groups into their parent clades, as long as at least top_n groups are larger
+    # returns the plot label of every name and the label order, most abundant first and Other last
+    group_totals = totals.to_dict()
+    merged_into = {}
+    # groups at the top of the hierarchy, or not in it, that were passed over
+    settled = set()
+    heap = [(total, name) for name, total in group_totals.items()]
+    heapq.heapify(heap)
+    while heap:
+        total, name = heapq.heappop(heap)
+        if group_totals.get(name) != total:
+            # merged away or grown since it was queued
+            continue
+        if len(group_totals) - 1 - len(settled) < top_n:
+            # this and every group left in the heap is kept as it is
+            break
+        target = parents.get(name)
+        while target in merged_into:
+            target = merged_into[target]
+        if target is None or target == name:
+            settled.add(name)
+            continue
+        del group_totals[name]
+        merged_into[name] = target
+        settled.discard(target)
+        group_totals[target] = group_totals.get(target, 0.0) + total
+        heapq.heappush(heap, (group_totals[target], target))
+
+    ranked = sorted(group_totals, key=lambda name: (-group_totals[name], name))
+    kept = set(ranked[:top_n])
+    groups = {}
+    for name in totals.index:
+        # the nearest kept clade holding the name, through the merges and then the hierarchy
+        group = name
+        seen = set()
+        while group is not None and group not in kept and group not in seen:
+            seen.add(group)
+            group = merged_into.get(group, parents.get(group))
+        groups[name] = group if group in kept else None
+    # clades holding sublineages are labeled like BA.2*
+    absorbed = {group for name, group in groups.items() if group is not None and group != name}
+    absorbed.update(name for name in kept if name not in groups)
+    labels = {name: OTHER if group is None else (f"{group}*" if group in absorbed else group)
+              for name, group in groups.items()}
+    order = [f"{name}*" if name in absorbed else name for name in ranked[:top_n]]
+    # freyja already summarizes some variants as Other, keep a single Other at the end
+    order = [label for label in order if label != OTHER]
+    if OTHER in labels.values():
+        order.append(OTHER)
+    return labels, order
+
+
+def collapse_lineages(long_df, column, parents, top_n):
+    # roll the names in column up to at most top_n groups plus Other, one row per sample and group
+    totals = long_df.groupby(column, observed=True)["abundance"].sum()
+    labels, order = get_lineage_groups(totals, parents, top_n)
+    collapsed = long_df.assign(**{column: long_df[column].astype(str).map(labels)})
+    collapsed = collapsed.groupby(["sample", column], observed=True, sort=False)["abundance"].sum().reset_index()
+    collapsed[column] = pd.Categorical(collapsed[column], categories=order)
+    return collapsed
+
+
+def get_plot_frames(df, lineages_yml=None, top_lineages=None):
+    # lineage and variant frames for the plots, rolled up to the top clades in large cohort mode
+    if lineages_yml:
+        # roll every lineage, not only those above 2%, up to the top clades
+        lineage_df = collapse_lineages(get_lineage_info(df, min_abundance=0), "lineage", load_lineage_parents(lineages_yml), top_lineages)
+        variant_df = collapse_lineages(get_variant_info(df), "variant", {}, top_lineages)
+    else:
+        lineage_df = get_lineage_info(df)
+        variant_df = get_variant_info(df)
+    return lineage_df, variant_df
+
+
+def make_benchmark_results(n_samples, n_lineages=8, seed=0):
+    # synthetic freyja_result.tsv rows shaped like the demix output
+    rng = np.random.default_rng(seed)
+    pool = [f"BA.{i}.{j}" for i in range(1, 6) for j in range(1, 40)]
+    variants = ["Omicron", "Delta", "Alpha", "Other"]
+    rows = []
+    for i in range(n_samples):
+        lineages = rng.choice(pool, n_lineages, replace=False)
+        abundances = rng.dirichlet(np.ones(n_lineages))
+        summarized = list(zip(variants, rng.dirichlet(np.ones(len(variants))).tolist()))
+        rows.append((f"S{i}", repr(summarized), " ".join(lineages),
+                     " ".join(f"{abundance:.8f}" for abundance in abundances), 1.5, 95.0))
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+
+@click.command()
+@click.option("--samples", default=10000, show_default=True, help="number of synthetic samples")
+def cli(samples):
+    # parsing throughput on a synthetic cohort
+    df = make_benchmark_results(samples)
+    start = time.time()
+    lineage_df = get_lineage_info(df)
+    lineage_time = time.time() - start
+    start = time.time()
+    variants_df = get_variant_info(df)
+    variant_time = time.time() - start
+    print(f"{samples} samples: lineages {len(lineage_df)} rows in {lineage_time:.3f}s "
+          f"({samples / lineage_time:,.0f} samples/s), variants {len(variants_df)} rows in {variant_time:.3f}s "
+          f"({samples / variant_time:,.0f} samples/s)")
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,126 @@
+import json
+import os
+import re
+import threading
+import time
+
+#
+# Job state manifest for the wrapper checks, the job stats and the report.
+# job_state.jsonl in the job directory is a journal with one json line for
+# every finished snakemake job: the rule, the sample and the size of each file
+# the job wrote. The steps that write sample results outside of snakemake
+# (result cache restore, demix recompute set up, batch demix) add their lines
+# the same way. Readers replay the journal once into a dict and look up the
+# stage status and file sizes there, instead of probing the shared filesystem
+# for every file of every sample. Without a journal, for example in the output
+# folder of a job from before the manifest, lookups fall back to the filesystem.
+#
+# In snakemake API mode the wrapper passes JobState.log_handler as a log
+# handler, as a subprocess snakemake loads this file with --log-handler-script
+# and calls the module level log_handler.
+#
+
+JOB_STATE_PATH = "job_state.jsonl"
+
+# sars2-onecodex writes these next to the iVar bam without them being rule outputs,
+# so an assembly with a failed stats step still keeps its bam
+SIDE_OUTPUTS = {".ivar.bam": [".statistics.tsv", ".detail.png"]}
+
+
+def clean_sample_id(sample_id):
+    # the sample id used in the file names and output paths: the last part of a path,
+    # letters, digits and underscores only
+    return re.sub(r"[^a-zA-Z0-9_]", "", sample_id.split("/")[-1])
+
+
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+class JobState:
+    def __init__(self, path=JOB_STATE_PATH, read=True):
+        # read=False for the steps that only add to the journal
+        self.path = path
+        # file path: size in bytes
+        self.files = {}
+        # sample: {rule or step: "finished" or "failed"}
+        self.stages = {}
+        # jobid: (rule, sample, output files) of the snakemake jobs running
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.probe = not os.path.exists(path)
+        if read and not self.probe:
+            with open(path, "r") as fh:
+                for line in fh:
+                    # a line cut short by a killed job is the last one, skip it
+                    try:
+                        self.apply(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+
+    def apply(self, entry):
+        for path, size in entry["files"].items():
+            if size is None:
+                self.files.pop(path, None)
+            else:
+                self.files[path] = size
+        if entry["sample"] is not None:
+            self.stages.setdefault(entry["sample"], {})[entry["step"]] = entry["status"]
+
+    def record(self, step, sample, paths, status="finished"):
+        # stat the files a step wrote once and add them to the journal
+        files = {os.path.relpath(path): file_size(path) for path in paths}
+        entry = {"time": round(time.time(), 3), "step": step, "sample": sample, "status": status, "files": files}
+        with self.lock:
+            with open(self.path, "a") as fh:
+                fh.write(json.dumps(entry) + "\n")
+            self.probe = False
+            self.apply(entry)
+
+    def size(self, path):
+        # size of a file written by the job, None when it was not written
+        if self.probe:
+            return file_size(path)
+        # paths relative to the job directory, the wrapper passes some of them as absolute paths
+        return self.files.get(os.path.relpath(path))
+
+    def exists(self, path):
+        return self.size(path) is not None
+
+    def nonempty(self, path):
+        return bool(self.size(path))
+
+    def stage(self, sample, step):
+        # "finished", "failed" or None when the step has not run for the sample
+        return self.stages.get(sample, {}).get(step)
+
+    def log_handler(self, msg):
+        # snakemake log handler, each job is recorded when snakemake reports it finished or failed
+        level = msg.get("level")
+        if level == "job_info":
+            # the sample is the wildcard named *sample, rules of the whole job have none
+            sample = next((value for key, value in msg.get("wildcards", {}).items() if key.endswith("sample")), None)
+            outputs = list(msg.get("output", []))
+            for output in list(outputs):
+                for suffix, side_suffixes in SIDE_OUTPUTS.items():
+                    if output.endswith(suffix):
+                        outputs += [output[:-len(suffix)] + side_suffix for side_suffix in side_suffixes]
+            self.jobs[msg.get("jobid")] = (msg.get("name"), sample, outputs)
+        elif level in ("job_finished", "job_error"):
+            job = self.jobs.pop(msg.get("jobid"), None)
+            if job is not None:
+                rule, sample, outputs = job
+                self.record(rule, sample, outputs, "finished" if level == "job_finished" else "failed")
+
+
+_snakemake_state = None
+
+def log_handler(msg):
+    # entry point for snakemake --log-handler-script
+    global _snakemake_state
+    if _snakemake_state is None:
+        _snakemake_state = JobState(read=False)
+    _snakemake_state.log_handler(msg)
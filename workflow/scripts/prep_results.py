@@ -1,7 +1,38 @@
 import click
 import json
+import numpy as np
 import pandas as pd
 import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from freyja_depths import read_depths
+from job_state import JobState
+
+#
+# Job stats for the HTML report (output/job_stats.tsv).
+# The per sample statistics.tsv, samtools flagstat and freyja depths files
+# are read by a pool of threads, each sample gives one record and the job
+# stats frame is built from all records at once. Which files exist comes from
+# the job state manifest, only the files there are opened.
+#
+
+# samtools flagstat lines, "QC-passed + QC-failed description", by the start of the description
+FLAGSTAT_FIELDS = [
+    ("in total", "flagstat_total"),
+    ("secondary", "flagstat_secondary"),
+    ("supplementary", "flagstat_supplementary"),
+    ("duplicates", "flagstat_duplicates"),
+    ("mapped (", "flagstat_mapped"),
+    ("paired in sequencing", "flagstat_paired"),
+    ("properly paired (", "flagstat_properly_paired"),
+]
+
+# share of the reference covered at these depths
+BREADTH_DEPTHS = [1, 10]
 
 
 def get_last_segment(path):
@@ -18,58 +49,87 @@ def parse_assembly_stats_file(file_path):
         parsed_values[key] = value
     return parsed_values
 
-def complile_stats(path):
-    # Step 1: get the sample ids from the config file 
+def parse_flagstat_file(file_path):
+    flagstat = {}
+    with open(file_path, 'r') as file:
+        for line in file:
+            found = re.match(r"(\d+) \+ (\d+) (.*)", line.strip())
+            if not found:
+                continue
+            for prefix, key in FLAGSTAT_FIELDS:
+                if found.group(3).startswith(prefix):
+                    flagstat.setdefault(key, int(found.group(1)))
+                    break
+    return flagstat
+
+def harvest_sample(sample_id, state):
+    # one record with the status and the stats of a sample, missing files leave their columns empty
+    record = {"sampleID": sample_id, "Assembly": "Incomplete", "Freyja - Analysis": "Incomplete"}
+    stats_path = f'output/{sample_id}/assembly/{sample_id}.statistics.tsv'
+    if state.nonempty(stats_path):
+        record["Assembly"] = "Complete"
+        # Every line in the assembly stats becomes a new column with the parsed value for that sample in the row
+        record.update(parse_assembly_stats_file(stats_path))
+    if state.exists(f'output/{sample_id}/freyja/{sample_id}_freyja_result.tsv'):
+        record["Freyja - Analysis"] = "Complete"
+    flagstat_path = f'output/{sample_id}/assembly/{sample_id}_flagstat.txt'
+    if state.exists(flagstat_path):
+        record.update(parse_flagstat_file(flagstat_path))
+    depths_path = f'output/{sample_id}/freyja/{sample_id}_freyja.depths'
+    if state.exists(depths_path):
+        positions, depths = read_depths(depths_path)
+        if len(depths) != 0:
+            for depth in BREADTH_DEPTHS:
+                record[f"breadth_{depth}x"] = round(100 * np.count_nonzero(depths >= depth) / len(depths), 2)
+    return record
+
+def complile_stats(path, workers):
+    start = time.time()
+    # Step 1: get the sample ids from the config file
     with open('config.json', 'r') as file:
         data = json.load(file)
 
-        # Extracting sample IDs from the "paired_end_libs" and "single_end_libs" lists
-        paired_end_sample_ids = [lib['sample_id'] for lib in data['params']['paired_end_libs']]
-        single_end_sample_ids = [lib['sample_id'] for lib in data['params']['single_end_libs']]
-        srr_sample_ids = [lib['sample_id'] for lib in data['params']['srr_libs']]
-
-        # Combine all sample IDs into one list
-        all_sample_ids = paired_end_sample_ids + single_end_sample_ids + srr_sample_ids
-
-        unique_sample_ids = list(set(all_sample_ids))
-
-
-    # make a dataframe with one row for each clean sample id
-    df_samples = pd.DataFrame(unique_sample_ids, columns=['sampleID'])
-    df_samples['Assembly'] = "Incomplete"
-    df_samples['Freyja - Analysis'] = "Incomplete"
-    df_samples['Freyja - Visualization'] = "Incomplete"
-
-    # # Step 2: Check the existence of output files and update the dataframe
-    for sample_id, idx in zip(df_samples['sampleID'], df_samples.index):
-        if os.path.getsize(f'output/{sample_id}/assembly/{sample_id}.statistics.tsv') != "Incomplete":
-            df_samples['Assembly'][idx] = "Complete"
-        ## parse the assembly stats file ##
-            assembly_stats = parse_assembly_stats_file(f'output/{sample_id}/assembly/{sample_id}.statistics.tsv')
-        # Every line in the assembly stats becomes a new column with the parsed value for that sample in the row
-            for key, value in assembly_stats.items():
-                df_samples.at[idx, key] = value
-        else:
-            df_samples['Assembly'] = "Incomplete"
-        if os.path.exists(f'output/{sample_id}/freyja/{sample_id}_freyja_result.tsv'):
-            df_samples['Freyja - Analysis'][idx] = "Complete"
-        if os.path.exists(f'plots/lineages_plot.html'):
-            df_samples['Freyja - Visualization'][idx] = "Complete"
-        # clean up primer path only show the bed file and remove the path
-        df_samples['primers'][idx] = get_last_segment(df_samples['primers'][idx])
-        # TO DO:parse samtools flagstats file
-        # parse_samtools_flagstats(f'output/{sample_id}/assembly/{sample_id}_flagstat.txt')
-
-    # the reference col shows an internal path - dropping because it does not help user
-    df_samples = df_samples.drop(['reference'], axis='columns')
-
-    # reorder columns
-
-    df_samples = df_samples[[
+        # the wrapper's sample registry holds the clean sample ids used in the output paths
+        # for every sample, including the samples of a demix recompute that has no reads
+        unique_sample_ids = list(dict.fromkeys(data['sample_registry']))
+
+    # Step 2: read the output files of every sample at once, then make a dataframe with one row for each clean sample id
+    state = JobState()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        records = list(pool.map(partial(harvest_sample, state=state), unique_sample_ids))
+    # samples dropped by the FASTQ preflight were never analyzed, they keep a row with the reason in the log
+    records += [{"sampleID": sample_id, "Assembly": "Failed preflight", "Freyja - Analysis": "Incomplete"}
+                for sample_id in data.get("preflight_failed", {}) if sample_id not in unique_sample_ids]
+    df_samples = pd.DataFrame.from_records(records, columns=None if records else ["sampleID"])
+    # large jobs have the compact report dataset instead of the plotly html
+    visualization = state.exists('plots/lineages_plot.html') or state.exists('plots/report_data.json')
+    df_samples['Freyja - Visualization'] = "Complete" if visualization else "Incomplete"
+    df_samples.loc[df_samples['Assembly'] == "Failed preflight", 'Freyja - Visualization'] = "Incomplete"
+    # clean up primer path only show the bed file and remove the path
+    if 'primers' in df_samples.columns:
+        df_samples['primers'] = df_samples['primers'].map(get_last_segment, na_action='ignore')
+
+    # flagstat percentages like samtools reports them
+    if 'flagstat_total' in df_samples.columns:
+        df_samples['flagstat_mapped_pct'] = (100 * df_samples['flagstat_mapped'] / df_samples['flagstat_total'].replace(0, np.nan)).round(2)
+    if 'flagstat_paired' in df_samples.columns:
+        df_samples['flagstat_properly_paired_pct'] = (100 * df_samples['flagstat_properly_paired'] / df_samples['flagstat_paired'].replace(0, np.nan)).round(2)
+
+    # hit or miss in the result cache for each sample, only when the job used the cache
+    cache_columns = []
+    if os.path.exists('tmp/result_cache_status.json'):
+        with open('tmp/result_cache_status.json', 'r') as file:
+            cache_status = json.load(file)
+        df_samples['Result Cache'] = df_samples['sampleID'].map(lambda x: cache_status.get(x, "miss"))
+        cache_columns = ["Result Cache"]
+
+    # reorder columns, the reference col shows an internal path - dropping because it does not help user
+    # columns of files no sample has are left empty
+    df_samples = df_samples.reindex(columns=[
     "sampleID",
     "Assembly",
     "Freyja - Analysis",
-    "Freyja - Visualization",
+    "Freyja - Visualization"] + cache_columns + [
     "depth_mean",
     "depth_median",
     "depth_stdv",
@@ -84,7 +144,17 @@ def complile_stats(path):
     "unmapped_reads",
     "primer_trim_count",
     "primer_trim_pct",
-    "variant_count"]]
+    "variant_count",
+    "flagstat_total",
+    "flagstat_mapped_pct",
+    "flagstat_properly_paired_pct",
+    "flagstat_duplicates",
+    "flagstat_secondary",
+    "flagstat_supplementary"] + [
+    f"breadth_{depth}x" for depth in BREADTH_DEPTHS])
+    # whole numbers stay whole numbers where some samples have no flagstat
+    flagstat_counts = ["flagstat_total", "flagstat_duplicates", "flagstat_secondary", "flagstat_supplementary"]
+    df_samples[flagstat_counts] = df_samples[flagstat_counts].astype("Int64")
 
     # rename columns
     df_samples.rename(columns = {"sampleID":"Sample ID", "depth_mean":"Depth Mean", \
@@ -94,15 +164,22 @@ def complile_stats(path):
                                 "fasta_length":"Fasta Length", "primers":"Primers", \
                                 "primer_count":"Primer Count","mapped_reads":"Mapped Reads",
                                 "unmapped_reads":"Unmapped Reads","primer_trim_count":"Primer Trim Count", \
-                                "primer_trim_pct":"Percentage of Primers Trimmed","variant_count":"Variant Count" }, inplace = True)
+                                "primer_trim_pct":"Percentage of Primers Trimmed","variant_count":"Variant Count", \
+                                "flagstat_total":"Total Alignments", "flagstat_mapped_pct":"Percentage Mapped", \
+                                "flagstat_properly_paired_pct":"Percentage Properly Paired", "flagstat_duplicates":"Duplicates", \
+                                "flagstat_secondary":"Secondary Alignments", "flagstat_supplementary":"Supplementary Alignments", \
+                                "breadth_1x":"Coverage Breadth 1x (%)", "breadth_10x":"Coverage Breadth 10x (%)" }, inplace = True)
     # write out to CSV - without the index column
     df_samples.to_csv(path, index = False, sep="\t")
+    msg = f"job stats: {len(df_samples)} samples with {workers} threads in {time.time() - start:.1f}s \n"
+    sys.stderr.write(msg)
 
 
 @click.command()
 @click.argument("path")
-def cli(path):
-    complile_stats(path)
+@click.option("--workers", default=16, show_default=True, help="threads reading the per sample files")
+def cli(path, workers):
+    complile_stats(path, workers)
 
 if __name__ == '__main__':
-    cli()
\ No newline at end of file
+    cli()
@@ -0,0 +1,117 @@
+import click
+import multiprocessing
+import os
+import pandas as pd
+import sys
+import time
+
+from freyja_tables import get_plot_frames, read_freyja_results
+from report_data import write_report_data
+from sample_level_plots import plot_lineage_by_samples, plot_variant_by_samples
+from time_series_plots import day_plot, get_time_series_tables, period_plot, read_dates
+
+#
+# Renders all report figures from one prepared dataset.
+# The Freyja results are parsed and the sample, day, week and month tables
+# are built once in the parent process, then the figures are built and
+# written by a pool of forked workers that inherit the prepared tables.
+# Writing the Plotly HTML dominates the run time for large cohorts, so the
+# figures are written side by side instead of one after another by the
+# sample level and time series scripts.
+# For large jobs the report can instead embed one compact dataset
+# (--report-data, see report_data.py) and build the figures in the browser,
+# then the Plotly HTML files are not needed at all (--no-figures).
+#
+
+# (output path, plot function, arguments before the output path), built in the parent and inherited by the forked workers
+FIGURES = []
+
+
+def render_figure(i):
+    out, func, args = FIGURES[i]
+    start = time.time()
+    try:
+        func(*args, out)
+    except Exception as e:
+        return out, "failed", time.time() - start, str(e)
+    return out, "complete", time.time() - start, ""
+
+
+def prepare_figures(freyja_results, plots_dir, dates, lineages_yml, top_lineages):
+    df = read_freyja_results(freyja_results)
+    lineage_df, variant_df = get_plot_frames(df, lineages_yml, top_lineages)
+    tables = get_time_series_tables(lineage_df, variant_df, read_dates(dates)) if dates else None
+    # reduce file size by rounding
+    sample_lineage_df = lineage_df.assign(abundance=lineage_df["abundance"].round(3))
+    figures = [
+        (os.path.join(plots_dir, "lineages_plot.html"), plot_lineage_by_samples, (sample_lineage_df,)),
+        (os.path.join(plots_dir, "variants_plot.html"), plot_variant_by_samples, (variant_df,)),
+    ]
+    if tables:
+        figures += [
+            (os.path.join(plots_dir, "lineages_by_day_plot.html"), day_plot, (tables[("lineage", "day")], 'Lineage', 'Lineage Abundance by Date')),
+            (os.path.join(plots_dir, "variants_by_day_plot.html"), day_plot, (tables[("variant", "day")], 'Variant', 'Variant Abundance by Date')),
+            (os.path.join(plots_dir, "lineages_by_week_plot.html"), period_plot, (tables[("lineage", "week")], 'Epiweek', 'Lineage', 'Lineage Abundance by Week')),
+            (os.path.join(plots_dir, "variants_by_week_plot.html"), period_plot, (tables[("variant", "week")], 'Epiweek', 'Variant', 'Variant Abundance by Week')),
+            (os.path.join(plots_dir, "lineages_by_month_plot.html"), period_plot, (tables[("lineage", "month")], 'Month', 'Lineage', 'Lineage Abundance by Month')),
+            (os.path.join(plots_dir, "variants_by_month_plot.html"), period_plot, (tables[("variant", "month")], 'Month', 'Variant', 'Variant Abundance by Month')),
+        ]
+    return figures, lineage_df, variant_df, tables
+
+
+def render_plots(freyja_results, plots_dir, dates, lineages_yml, top_lineages, workers, timing_path, report_data_path=None, no_figures=False):
+    global FIGURES
+    start = time.time()
+    os.makedirs(plots_dir, exist_ok=True)
+    FIGURES, lineage_df, variant_df, tables = prepare_figures(freyja_results, plots_dir, dates, lineages_yml, top_lineages)
+    if report_data_path:
+        write_report_data(report_data_path, lineage_df, variant_df, tables)
+        msg = f"report dataset: {report_data_path} {os.path.getsize(report_data_path) / 1e6:.2f} MB \n"
+        sys.stderr.write(msg)
+    if no_figures:
+        FIGURES = []
+    prepare_time = time.time() - start
+    if len(FIGURES) == 0:
+        msg = f"plots: no figures rendered, preparing tables {prepare_time:.1f}s \n"
+        sys.stderr.write(msg)
+        return
+
+    workers = max(1, min(workers, len(FIGURES)))
+    start = time.time()
+    results = []
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        for out, status, seconds, error in pool.imap_unordered(render_figure, range(len(FIGURES))):
+            msg = f"plot {out}: {status} in {seconds:.1f}s {error} \n"
+            sys.stderr.write(msg)
+            results.append((out, status, seconds, error))
+    render_time = time.time() - start
+
+    timing_df = pd.DataFrame(results, columns=["figure", "status", "seconds", "error"])
+    if timing_path:
+        os.makedirs(os.path.dirname(timing_path) or ".", exist_ok=True)
+        timing_df.to_csv(timing_path, sep="\t", index=False, float_format="%.2f")
+    msg = (f"plots: {len(FIGURES)} figures with {workers} workers, preparing tables {prepare_time:.1f}s, "
+        f"rendering {render_time:.1f}s, slowest figure {timing_df['seconds'].max():.1f}s \n")
+    sys.stderr.write(msg)
+    failed = timing_df[timing_df["status"] != "complete"]["figure"].tolist()
+    if len(failed) != 0:
+        msg = f"plots failed: {failed} \n"
+        sys.stderr.write(msg)
+        sys.exit(1)
+
+
+@click.command()
+@click.argument("freyja_results")
+@click.argument("plots_dir")
+@click.option("--dates", default=None, help="edited sample time metadata csv, adds the day, week and month plots")
+@click.option("--lineages-yml", default=None, help="lineages.yml hierarchy, turns on large cohort mode")
+@click.option("--top-lineages", default=20, show_default=True, help="lineages kept in large cohort mode")
+@click.option("--workers", default=4, show_default=True, help="maximum number of figures rendered at once")
+@click.option("--timing", "timing_path", default=None, help="write the per figure timing to this tsv")
+@click.option("--report-data", "report_data_path", default=None, help="write the compact report dataset to this json")
+@click.option("--no-figures", is_flag=True, help="skip the Plotly HTML figures, the report builds them from the dataset")
+def cli(freyja_results, plots_dir, dates, lineages_yml, top_lineages, workers, timing_path, report_data_path, no_figures):
+    render_plots(freyja_results, plots_dir, dates, lineages_yml, top_lineages, workers, timing_path, report_data_path, no_figures)
+
+if __name__ == '__main__':
+    cli()
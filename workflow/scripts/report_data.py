@@ -0,0 +1,87 @@
+import base64
+import json
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.io as pio
+
+from time_series_plots import colorblind_palette
+
+#
+# Compact plot dataset for the report (plots/report_data.json).
+# Instead of one Plotly HTML file per figure, each holding its own copy of
+# every sample, lineage and abundance, the report embeds this dataset once
+# and report_plots.js builds the sample, day, week and month figures in the
+# browser. Lineage and variant names are stored once, every table is a list
+# of x labels plus little endian typed arrays of x index, name index and
+# abundance, and abundances are rounded to REPORT_SCALE steps so they fit
+# in 16 bits.
+#
+
+# abundances are stored as integers in 1/REPORT_SCALE steps, 0.01%
+REPORT_SCALE = 10000
+
+
+def compact_column(values):
+    # base64 of the smallest unsigned typed array holding the values
+    values = np.asarray(values)
+    largest = int(values.max()) if len(values) else 0
+    dtype = "u1" if largest < 2**8 else "u2" if largest < 2**16 else "u4"
+    return {"dtype": dtype, "data": base64.b64encode(values.astype("<" + dtype).tobytes()).decode("ascii")}
+
+
+def compact_table(table, x_column, name_column, x_labels):
+    # long (x, name, abundance) table -> x labels and typed index and abundance columns
+    table = table.groupby([x_column, name_column], observed=True, sort=False)["abundance"].sum().reset_index()
+    values = np.rint(table["abundance"].to_numpy(dtype=float) * REPORT_SCALE).clip(0, REPORT_SCALE)
+    return {
+        "x": [str(label) for label in x_labels],
+        "xi": compact_column(pd.Categorical(table[x_column].astype(str), categories=x_labels).codes),
+        "name": compact_column(table[name_column].cat.codes.to_numpy()),
+        "value": compact_column(values),
+    }
+
+
+def sample_figure(df, column, title, legend_title):
+    # samples in the order of the results, like get_sample_pivot
+    samples = [str(sample) for sample in df["sample"].unique()]
+    figure = compact_table(df, "sample", column, samples)
+    figure.update({"plot": "sample", "names": column, "title": title, "legend_title": legend_title, "xaxis_title": "Sample"})
+    return figure
+
+
+def period_figure(table, kind, plot, title, legend_title, xaxis_title):
+    # dates, epiweeks and months sort as text
+    figure = compact_table(table.rename(columns={"normalized": "abundance"}), "x", "name", sorted(table["x"].astype(str).unique()))
+    figure.update({"plot": plot, "names": kind, "title": title, "legend_title": legend_title, "xaxis_title": xaxis_title})
+    return figure
+
+
+def get_report_data(lineage_df, variant_df, tables=None):
+    figures = {
+        "lineages_plot": sample_figure(lineage_df, "lineage", "Lineage Abundance per Sample", "Lineage"),
+        "variants_plot": sample_figure(variant_df, "variant", "Variant Abundance by Sample", "Variant"),
+    }
+    if tables:
+        for kind, legend_title in [("lineage", "Lineage"), ("variant", "Variant")]:
+            figures[f"{kind}s_by_day_plot"] = period_figure(tables[(kind, "day")], kind, "day", f"{legend_title} Abundance by Date", legend_title, "Date")
+            figures[f"{kind}s_by_week_plot"] = period_figure(tables[(kind, "week")], kind, "period", f"{legend_title} Abundance by Week", legend_title, "Epiweek")
+            figures[f"{kind}s_by_month_plot"] = period_figure(tables[(kind, "month")], kind, "period", f"{legend_title} Abundance by Month", legend_title, "Month")
+    return {
+        "scale": REPORT_SCALE,
+        "palette": colorblind_palette,
+        # the python plotly theme, so the figures look like the ones written by render_plots.py
+        "template": pio.templates[pio.templates.default].to_plotly_json(),
+        "names": {
+            "lineage": [str(name) for name in lineage_df["lineage"].cat.categories],
+            "variant": [str(name) for name in variant_df["variant"].cat.categories],
+        },
+        "figures": figures,
+    }
+
+
+def write_report_data(path, lineage_df, variant_df, tables=None):
+    report_data = get_report_data(lineage_df, variant_df, tables)
+    with open(path, "w") as fh:
+        json.dump(report_data, fh, separators=(",", ":"), cls=plotly.utils.PlotlyJSONEncoder)
+    return report_data
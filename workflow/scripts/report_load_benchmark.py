@@ -0,0 +1,97 @@
+import click
+import json
+import os
+import plotly
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+#
+# Local load time benchmark for SARS2Wastewater_report.html.
+# Loads the report in a headless Chrome or Chromium, once as written (plots
+# rendered as they scroll into view) and once with every plot rendered on
+# load, and reports the time to the load event and the number of figures
+# drawn by then. Plotly is loaded from the copy bundled with the plotly
+# python package instead of the CDN, so the benchmark runs offline.
+#
+
+BROWSERS = ["chromium", "chromium-browser", "google-chrome", "google-chrome-stable", "chrome"]
+
+# written into the page once the load event has fired, read back from the dumped DOM
+METRICS_SCRIPT = """<script>
+window.addEventListener("load", function () {
+    var navigation = performance.getEntriesByType("navigation")[0];
+    var metrics = {
+        load_ms: navigation ? navigation.loadEventStart : performance.now(),
+        dom_content_loaded_ms: navigation ? navigation.domContentLoadedEventEnd : 0,
+        figures_rendered: document.querySelectorAll(".js-plotly-plot").length
+    };
+    var pre = document.createElement("pre");
+    pre.id = "load-metrics";
+    pre.textContent = JSON.stringify(metrics);
+    document.body.appendChild(pre);
+});
+</script>"""
+
+
+def find_browser(browser):
+    if browser:
+        return browser
+    for name in BROWSERS:
+        if shutil.which(name):
+            return shutil.which(name)
+    msg = f"no headless browser found, tried {BROWSERS}, pass one with --browser \n"
+    sys.stderr.write(msg)
+    sys.exit(1)
+
+
+def write_benchmark_page(report_path, out_path, eager):
+    with open(report_path, "r") as fh:
+        html = fh.read()
+    plotly_js = os.path.join(os.path.dirname(plotly.__file__), "package_data", "plotly.min.js")
+    html = re.sub(r'<script src="https://cdn\.plot\.ly/[^"]*"></script>', f'<script src="file://{plotly_js}"></script>', html)
+    if eager:
+        html = html.replace("<body>", "<body><script>window.REPORT_EAGER = true;</script>", 1)
+    # after the last closing body tag, the report is two html documents written back to back
+    split = html.rfind("</body>")
+    html = html[:split] + METRICS_SCRIPT + html[split:]
+    with open(out_path, "w") as fh:
+        fh.write(html)
+
+
+def load_page(browser, page_path, timeout):
+    command = [browser, "--headless=new", "--disable-gpu", "--no-sandbox", "--allow-file-access-from-files",
+               "--window-size=1280,900", "--dump-dom", f"file://{os.path.abspath(page_path)}"]
+    result = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    found = re.search(r'<pre id="load-metrics">(.*?)</pre>', result.stdout, re.DOTALL)
+    if not found:
+        msg = f"no load metrics in the dumped page {page_path}: {result.stderr[-500:]} \n"
+        sys.stderr.write(msg)
+        return None
+    return json.loads(found.group(1).replace("&quot;", '"'))
+
+
+@click.command()
+@click.argument("report")
+@click.option("--browser", default=None, help="chrome or chromium binary, found on the PATH by default")
+@click.option("--runs", default=5, show_default=True, help="page loads per mode, the median is reported")
+@click.option("--timeout", default=300, show_default=True, help="seconds allowed for one page load")
+def cli(report, browser, runs, timeout):
+    browser = find_browser(browser)
+    print("mode\tload_ms\tdom_content_loaded_ms\tfigures_rendered\tsize_mb")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode, eager in [("lazy", False), ("eager", True)]:
+            page_path = os.path.join(tmp_dir, f"{mode}.html")
+            write_benchmark_page(report, page_path, eager)
+            metrics = [m for m in (load_page(browser, page_path, timeout) for _ in range(runs)) if m]
+            if not metrics:
+                continue
+            print(f"{mode}\t{statistics.median(m['load_ms'] for m in metrics):.0f}\t"
+                  f"{statistics.median(m['dom_content_loaded_ms'] for m in metrics):.0f}\t"
+                  f"{metrics[0]['figures_rendered']}\t{os.path.getsize(report) / 1e6:.2f}")
+
+if __name__ == '__main__':
+    cli()
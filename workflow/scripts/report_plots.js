@@ -0,0 +1,129 @@
+// Renders the report figures when they scroll into view or their section is expanded.
+// Plotly html pasted into the report keeps its plot script as <script type="text/x-lazy-plot">, which is run
+// when the plot comes into view. Compact reports embed the dataset written by report_data.py once as
+// <script id="report-data" type="application/json"> and every <div data-figure="..."> is built from it.
+(function () {
+    var element = document.getElementById("report-data");
+    var data = element ? JSON.parse(element.textContent) : null;
+    var arrayTypes = {u1: Uint8Array, u2: Uint16Array, u4: Uint32Array};
+
+    function decode(column) {
+        var text = atob(column.data);
+        var bytes = new Uint8Array(text.length);
+        for (var i = 0; i < text.length; i++) {
+            bytes[i] = text.charCodeAt(i);
+        }
+        return new arrayTypes[column.dtype](bytes.buffer);
+    }
+
+    // one bar trace per name, names in dataset order, like the pivot tables of the python plots
+    function buildTraces(figure, fill) {
+        var xi = decode(figure.xi), name = decode(figure.name), value = decode(figure.value);
+        var names = data.names[figure.names];
+        var rows = {};
+        for (var i = 0; i < xi.length; i++) {
+            if (!(name[i] in rows)) {
+                rows[name[i]] = new Array(figure.x.length).fill(fill);
+            }
+            rows[name[i]][xi[i]] = value[i] / data.scale;
+        }
+        var order = Object.keys(rows).map(Number).sort(function (a, b) { return a - b; });
+        return order.map(function (code, i) {
+            return {
+                type: "bar",
+                x: figure.x,
+                y: rows[code],
+                name: names[code],
+                marker: {color: data.palette[i % data.palette.length]}
+            };
+        });
+    }
+
+    function buildLayout(figure) {
+        var layout = {
+            barmode: "stack",
+            template: data.template,
+            title: {text: figure.title, font: {size: 24}},
+            xaxis: {title: {text: figure.xaxis_title, font: {size: 18}}, tickangle: -45, tickfont: {size: 16}},
+            yaxis: {title: {text: "Abundance (%)", font: {size: 18}}, tickformat: ".0%", tickfont: {size: 16}},
+            legend: {title: {text: figure.legend_title, font: {size: 16}}, font: {size: 14}},
+            hoverlabel: {font: {size: 16, family: figure.plot === "sample" ? "Roboto" : "Arial"}},
+            height: 700
+        };
+        if (figure.plot !== "sample") {
+            layout.xaxis.type = "category";
+        }
+        if (figure.plot === "period") {
+            layout.xaxis.categoryorder = "category ascending";
+        }
+        return layout;
+    }
+
+    function buildFigure(div) {
+        var figure = data.figures[div.getAttribute("data-figure")];
+        if (!figure) {
+            return;
+        }
+        // dates without a name are empty bars, weeks and months leave them out
+        var traces = buildTraces(figure, figure.plot === "day" ? 0 : null);
+        traces.forEach(function (trace) {
+            if (figure.plot === "day") {
+                trace.hovertemplate = "<b>" + trace.name + "</b><br>Normalized Avg:%{y:.2%}<extra></extra>";
+            } else {
+                trace.hovertemplate = "<b>%{x}</b><br>%{y:.2%}<br><b>%{data.name}</b><extra></extra>";
+            }
+            if (figure.plot === "period") {
+                trace.marker.line = {width: 0};
+            }
+        });
+        Plotly.newPlot(div, traces, buildLayout(figure), {responsive: true});
+    }
+
+    function runPlotScript(script) {
+        var run = document.createElement("script");
+        run.text = script.text;
+        script.parentNode.replaceChild(run, script);
+    }
+
+    // element that has to come into view -> function rendering its figure
+    var pending = new Map();
+    if (data) {
+        document.querySelectorAll("div[data-figure]").forEach(function (div) {
+            pending.set(div, function () { buildFigure(div); });
+        });
+    }
+    document.querySelectorAll('script[type="text/x-lazy-plot"]').forEach(function (script) {
+        pending.set(script.parentElement, function () { runPlotScript(script); });
+    });
+
+    function render(target) {
+        var renderFigure = pending.get(target);
+        if (renderFigure) {
+            pending.delete(target);
+            renderFigure();
+        }
+    }
+
+    function renderAll() {
+        Array.from(pending.keys()).forEach(render);
+    }
+
+    // REPORT_EAGER renders everything on load, for the load time benchmark
+    if (window.REPORT_EAGER || !("IntersectionObserver" in window)) {
+        renderAll();
+        return;
+    }
+    // plots in collapsed sections are not visible, they come into view when the section is expanded
+    var observer = new IntersectionObserver(function (entries) {
+        entries.forEach(function (entry) {
+            if (entry.isIntersecting) {
+                observer.unobserve(entry.target);
+                render(entry.target);
+            }
+        });
+    }, {rootMargin: "200px 0px"});
+    pending.forEach(function (renderFigure, target) {
+        observer.observe(target);
+    });
+    window.addEventListener("beforeprint", renderAll);
+})();
@@ -0,0 +1,86 @@
+// Virtualized sample tables for large reports.
+// The rows of a large table are embedded once as compact json, <script type="application/json" id="...">,
+// next to a <div class="virtual-table" data-table="..."> holding its header. Only the rows scrolled into
+// view are in the page, so tables with thousands of samples stay responsive, and the rows can be
+// filtered by the first column.
+(function () {
+    // rows drawn above and below the visible ones
+    var OVERSCAN = 20;
+    var progressColors = {Complete: "lightgreen", Incomplete: "lightcoral", "Failed preflight": "lightcoral"};
+
+    function setupTable(container) {
+        var allRows = JSON.parse(document.getElementById(container.getAttribute("data-table")).textContent).rows;
+        var progress = container.hasAttribute("data-progress");
+        var scroller = container.querySelector(".virtual-table-scroll");
+        var tbody = container.querySelector("tbody");
+        var filter = container.querySelector("input");
+        var count = container.querySelector(".virtual-table-count");
+        var rows = allRows;
+        var rowHeight = 0;
+
+        function buildRow(values) {
+            var tr = document.createElement("tr");
+            values.forEach(function (value) {
+                var td = document.createElement("td");
+                td.textContent = value === null ? "nan" : value;
+                if (progress && value in progressColors) {
+                    td.style.backgroundColor = progressColors[value];
+                    td.style.opacity = 0.7;
+                }
+                tr.appendChild(td);
+            });
+            return tr;
+        }
+
+        function spacer(height) {
+            var tr = document.createElement("tr");
+            tr.style.height = height + "px";
+            return tr;
+        }
+
+        function render() {
+            if (!rowHeight && rows.length) {
+                // every row is one line high, measured once from a drawn row
+                tbody.replaceChildren(buildRow(rows[0]));
+                rowHeight = tbody.firstChild.getBoundingClientRect().height || 29;
+            }
+            var height = rowHeight || 29;
+            var first = Math.max(0, Math.floor(scroller.scrollTop / height) - OVERSCAN);
+            var last = Math.min(rows.length, first + Math.ceil(scroller.clientHeight / height) + 2 * OVERSCAN);
+            var fragment = document.createDocumentFragment();
+            fragment.appendChild(spacer(first * height));
+            for (var i = first; i < last; i++) {
+                fragment.appendChild(buildRow(rows[i]));
+            }
+            fragment.appendChild(spacer((rows.length - last) * height));
+            tbody.replaceChildren(fragment);
+        }
+
+        function updateCount() {
+            count.textContent = rows.length === allRows.length ? allRows.length + " samples"
+                : rows.length + " of " + allRows.length + " samples";
+        }
+
+        filter.addEventListener("input", function () {
+            var text = filter.value.toLowerCase();
+            rows = text ? allRows.filter(function (row) { return String(row[0]).toLowerCase().indexOf(text) !== -1; }) : allRows;
+            scroller.scrollTop = 0;
+            updateCount();
+            render();
+        });
+        var scheduled = false;
+        scroller.addEventListener("scroll", function () {
+            if (!scheduled) {
+                scheduled = true;
+                requestAnimationFrame(function () {
+                    scheduled = false;
+                    render();
+                });
+            }
+        });
+        updateCount();
+        render();
+    }
+
+    document.querySelectorAll("div.virtual-table").forEach(setupTable);
+})();
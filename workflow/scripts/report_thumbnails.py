@@ -0,0 +1,94 @@
+import click
+import json
+import multiprocessing
+import os
+import pandas as pd
+import sys
+import time
+from PIL import Image
+
+from job_state import JobState
+
+#
+# Thumbnails of the per sample coverage plots for the HTML report.
+# The report used to base64 inline every full resolution
+# output/{sample}/assembly/{sample}.detail.png, which runs to hundreds of MB
+# for large jobs. Each plot is shrunk to a small WebP thumbnail by a pool of
+# workers and only the thumbnails are inlined, the full size plot stays
+# where the assembly wrote it and the report links to it. Pillow builds without
+# WebP support write PNG thumbnails instead.
+# The manifest lists every sample in registry order with its thumbnail and
+# full size plot, samples without a readable plot are marked as missing or
+# failed and left out of the report.
+#
+
+MANIFEST_COLUMNS = ["sample", "image", "thumbnail", "status", "image_bytes", "thumbnail_bytes", "error"]
+
+
+def thumbnail_format():
+    # WebP when this Pillow can write it, PNG otherwise
+    Image.init()
+    if "WEBP" in Image.SAVE:
+        return "WEBP", "webp", {"method": 6}
+    return "PNG", "png", {"optimize": True}
+
+
+def make_thumbnail(task):
+    sample, image_path, image_bytes, thumbnail_path, width, quality, image_format, save_options = task
+    if image_bytes is None:
+        return sample, image_path, "", "missing", 0, 0, ""
+    try:
+        with Image.open(image_path) as image:
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+            # keep the aspect ratio, only the width is limited
+            image.thumbnail((width, image.height), Image.LANCZOS)
+            image.save(thumbnail_path, image_format, quality=quality, **save_options)
+    except Exception as e:
+        # unreadable, oversized (DecompressionBombError) or unwritable plots only lose their thumbnail
+        return sample, image_path, "", "failed", image_bytes, 0, str(e)
+    return sample, image_path, thumbnail_path, "complete", image_bytes, os.path.getsize(thumbnail_path), ""
+
+
+def make_thumbnails(samples, thumbnails_dir, manifest_path, width, quality, workers):
+    start = time.time()
+    os.makedirs(thumbnails_dir, exist_ok=True)
+    # which samples have a coverage plot and its size come from the job state manifest
+    state = JobState()
+    image_format, extension, save_options = thumbnail_format()
+    image_paths = {sample: f"output/{sample}/assembly/{sample}.detail.png" for sample in samples}
+    tasks = [(sample, image_paths[sample], state.size(image_paths[sample]),
+              os.path.join(thumbnails_dir, f"{sample}.detail.{extension}"), width, quality, image_format, save_options)
+             for sample in samples]
+    results = []
+    if tasks:
+        workers = max(1, min(workers, len(tasks)))
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            results = list(pool.imap(make_thumbnail, tasks, chunksize=8))
+    manifest_df = pd.DataFrame(results, columns=MANIFEST_COLUMNS)
+    manifest_df.to_csv(manifest_path, sep="\t", index=False)
+
+    failed = manifest_df[manifest_df["status"] == "failed"]
+    for sample, error in zip(failed["sample"], failed["error"]):
+        msg = f"no thumbnail for the coverage plot of {sample}: {error} \n"
+        sys.stderr.write(msg)
+    msg = (f"thumbnails: {(manifest_df['status'] == 'complete').sum()} of {len(tasks)} coverage plots as {extension} in {time.time() - start:.1f}s "
+        f"with {workers if tasks else 0} workers, {manifest_df['image_bytes'].sum() / 1e6:.2f} MB -> "
+        f"{manifest_df['thumbnail_bytes'].sum() / 1e6:.2f} MB \n")
+    sys.stderr.write(msg)
+
+
+@click.command()
+@click.argument("thumbnails_dir")
+@click.argument("manifest")
+@click.option("--config", "config_path", default="config.json", show_default=True, help="job config holding the sample registry")
+@click.option("--width", default=480, show_default=True, help="thumbnail width in pixels")
+@click.option("--quality", default=80, show_default=True, help="WebP quality of the thumbnails, unused for PNG")
+@click.option("--workers", default=4, show_default=True, help="thumbnails made at once")
+def cli(thumbnails_dir, manifest, config_path, width, quality, workers):
+    with open(config_path, "r") as fh:
+        config = json.load(fh)
+    make_thumbnails(list(config["sample_registry"]), thumbnails_dir, manifest, width, quality, workers)
+
+if __name__ == '__main__':
+    cli()
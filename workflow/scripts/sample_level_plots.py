@@ -6,11 +6,11 @@ Created on Mon Apr 29 06:33:08 2024
 @author: nbowers
 """
 import matplotlib.colors as mcolors
-import numpy as np
-import pandas as pd
 import plotly.graph_objects as go
 import sys
 
+from freyja_tables import get_plot_frames, read_freyja_results
+
 colorblind_palette = [
     "#377eb8",  # Blue
     "#ff7f00",  # Orange
@@ -32,50 +32,20 @@ colorblind_palette = [
 def get_extended_color_palette(n_colors):
     return [mcolors.hsv_to_rgb((x*1.0/n_colors, 0.5, 0.9)) for x in range(n_colors)]
 
-def get_lineage_info(df):    
-    lineage_df = df[["sample", "lineages", "abundances"]].copy()
-    lineage_df['lineages'] = df['lineages'].str.split()
-    lineage_df['abundances'] = df['abundances'].str.split().apply(lambda x: [float(i) for i in x])
-    
-    # Expand the lists into rows
-    rows = []
-    for _, row in lineage_df.iterrows():
-        for lineage, abundance in zip(row['lineages'], row['abundances']):
-            rows.append({'sample': row['sample'], 'lineage': lineage, 'abundance': abundance})
-
-    # Create a new DataFrame
-    df_lineages = pd.DataFrame(rows)
-    # drop lineage from plotting if it is less than 2%
-    df_lineages = df_lineages[df_lineages['abundance'] >= 0.02]
-    return df_lineages
-
-def get_variant_info(df):
-    rows = []
-    # Subsection only the data we need
-    samples_variants_info = df[["sample", "summarized"]]
-    # Will use the entire variant name
-    for index, row in samples_variants_info.iterrows():
-        sample_id = row["sample"]
-        tuples_list = row['summarized']
-        tuples_list = list(eval(tuples_list))
-        for tup in tuples_list:
-            name, abundance = tup
-            # Append a new row to the rows list
-            rows.append({'sample_id': sample_id, 'Variant': name, 'abundance': abundance})
-        # Create a new dataframe from the rows list
-    variants_df = pd.DataFrame(rows)
-    return variants_df
+def get_sample_pivot(df, column):
+    # one row per lineage or variant and one column per sample, samples in the order of the results
+    pivot_df = df.pivot_table(index=column, columns='sample', values='abundance', aggfunc='sum', observed=True)
+    return pivot_df.reindex(columns=df['sample'].unique())
 
 def plot_lineage_by_samples(df_lineages, sample_lineage_out):
     # Create a Plotly figure
     fig = go.Figure()
     # Add traces
-    lineages = df_lineages['lineage'].unique()
-    for i, lineage in enumerate(lineages):
-        df_lineage = df_lineages[df_lineages['lineage'] == lineage]
+    pivot_df = get_sample_pivot(df_lineages, 'lineage')
+    for i, lineage in enumerate(pivot_df.index):
         fig.add_trace(go.Bar(
-            x=df_lineage['sample'],
-            y=df_lineage['abundance'],
+            x=pivot_df.columns,
+            y=pivot_df.loc[lineage],
             name=lineage,
             marker_color=colorblind_palette[i % len(colorblind_palette)], # loop through the color palette
             hoverinfo='y+name',
@@ -104,17 +74,15 @@ def plot_lineage_by_samples(df_lineages, sample_lineage_out):
 
 
 def plot_variant_by_samples(df_variants, sample_variant_out):
-    # Create a list of unique variants
-    variants = df_variants['Variant'].unique()
+    pivot_df = get_sample_pivot(df_variants, 'variant')
     # Initialize a figure
     fig = go.Figure()
 
     # Add a bar for each variant
-    for i, variant in enumerate(variants):
-        variant_data = df_variants[df_variants['Variant'] == variant]
+    for i, variant in enumerate(pivot_df.index):
         fig.add_trace(go.Bar(
-            x=variant_data['sample_id'],
-            y=variant_data['abundance'],
+            x=pivot_df.columns,
+            y=pivot_df.loc[variant],
             marker_color=colorblind_palette[i % len(colorblind_palette)], # loop through the color palette
             name=variant
         ))
@@ -142,17 +110,15 @@ def main(argv):
     freyja_results = argv[1]
     sample_lineage_out = argv[2]
     sample_variant_out = argv[3]
+    # large cohort mode: lineages.yml and the number of lineages to keep
+    lineages_yml = argv[4] if len(argv) > 5 else None
 
-    df = pd.read_csv(freyja_results, sep="\t")
-    df.columns = ["sample", "summarized", "lineages", "abundances", "resid","coverage"]
-    # chop off the file name and extension 
-    df["sample"] = df["sample"].apply(lambda x: x.replace('_freyja_variants.tsv', ''))
-    # lineages
-    df_lineages = get_lineage_info(df)
+    df = read_freyja_results(freyja_results)
+    top_lineages = int(argv[5]) if lineages_yml else None
+    df_lineages, df_variants = get_plot_frames(df, lineages_yml, top_lineages)
     # reduce file size by rounding
     df_lineages["abundance"] = df_lineages["abundance"].round(3)
     plot_lineage_by_samples(df_lineages, sample_lineage_out)
-    df_variants = get_variant_info(df)
     plot_variant_by_samples(df_variants, sample_variant_out)
     print("Sample stacked bar plots generated ")
 
@@ -5,16 +5,13 @@ Created on Mon Apr 29 06:33:08 2024
 
 @author: nbowers
 """
-from datetime import date
-from epiweeks import Week
-
-import matplotlib.colors as mcolors
 import os.path
-import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import sys
 
+from freyja_tables import get_plot_frames, read_freyja_results
+
 colorblind_palette = [
     "#377eb8",  # Blue
     "#ff7f00",  # Orange
@@ -33,123 +30,91 @@ colorblind_palette = [
     "#b2df8a"   # Light Green
 ]
 
-def calculate_epiweek(date_str):
-    # Split the date string and convert to integers
-    my_date = date_str.split('/')
-    year = int(my_date[2])
-    month = int(my_date[0])
-    day = int(my_date[1])
-    # Create a date object
-    my_date = date(year, month, day)
-    # Calculate epidemiological week
-    epiweek = Week.fromdate(my_date)
-    # Return the epiweek as string (or as a Week object, depending on your needs)
-    return epiweek.isoformat()  # Returns the ISO formatted week, like '2021W16'
-
-def calculate_month(date_str):
-    # Split the date string and convert to integers
-    my_date = date_str.split('/')
-    year = int(my_date[2])
-    month = int(my_date[0])
-    day = int(my_date[1])
-    return f"{year}/{month:02d}"
+PERIODS = ["day", "week", "month"]
 
 # def get_extended_color_palette(n_colors):
 #     return [mcolors.hsv_to_rgb((x*1.0/n_colors, 0.5, 0.9)) for x in range(n_colors)]
 
-def get_lineage_info(df):
-    lineage_df = df[["sample", "lineages", "abundances"]].copy()
-    # Split the 'lineages' and 'abundances' columns into lists
-    lineage_df['lineages'] = df['lineages'].str.split()
-    lineage_df['abundances'] = df['abundances'].str.split().apply(lambda x: [float(i) for i in x])
-
-    # Expand the lists into rows
-    rows = []
-    for _, row in lineage_df.iterrows():
-        for lineage, abundance in zip(row['lineages'], row['abundances']):
-            rows.append({'sample': row['sample'], 'lineage': lineage, 'abundance': abundance})
-
-    # Create a new DataFrame
-    df_lineages = pd.DataFrame(rows)
-    # drop lineage from plotting if it is less than 2%
-    df_lineages = df_lineages[df_lineages['abundance'] >= 0.02]
-    return df_lineages
-
-def get_variant_info(df):
-    rows = []
-    # Subsection only the data we need
-    samples_variants_info = df[["sample", "summarized"]]
-    # Will use the entire variant name
-    for index, row in samples_variants_info.iterrows():
-        sample_id = row["sample"]
-        tuples_list = row['summarized']
-        tuples_list = list(eval(tuples_list))
-        for tup in tuples_list:
-            name, abundance = tup
-            # Append a new row to the rows list
-            rows.append({'sample_id': sample_id, 'Variant': name, 'abundance': abundance})
-        # Create a new dataframe from the rows list
-    variants_df = pd.DataFrame(rows)
-    return variants_df
-
-
-def get_variant_day_info(df, dates_df):
-    merged_df = {}
-    # first get variant information from the freyja output file
-    freyja_info = get_variant_info(df)
-    variant_info = get_variant_info(df)
-    merged_df = pd.merge(variant_info, dates_df, left_on='sample_id', right_on='sample')
-    merged_df["formatted_date"] = pd.to_datetime(merged_df['date']).dt.date
-    return merged_df
-
-def day_variant_plot(merged_df, day_variant_out):
-    # group rows that have the same sample id together
-    # group sample ids with the same date together 
-    # varaints will group together
-    # merged_df['normalized'] = merged_df[['date','Percent']].groupby(['date'])['Percent'].transform(lambda x: x / x.sum())
-    merged_df['normalized'] = merged_df[['date','abundance']].groupby(['date'])['abundance'].transform(lambda x: x / x.sum())    
-    merged_df = merged_df.sort_values(by='date')
-    merged_df["formatted_date"] = pd.to_datetime(merged_df['date']).dt.date
-    # START: merge the samples by date and linage
-    # Break it up by sample and lineage
-    grouped = merged_df.groupby(['formatted_date', 'Variant'])['normalized'].agg(['sum', 'count']).reset_index()
-
-    # Calculate the normalized average by dividing the sum by the count
-    grouped['normalized_avg'] = grouped['sum'] / grouped['count']
-
-    # Select the relevant columns for the final DataFrame
-    final_df = grouped[['formatted_date', 'Variant', 'normalized_avg']]
-
-    # Rename columns for clarity
-    final_df.columns = ['date', 'Variant', 'normalized_avg']
-
-    # Round values
-    final_df['normalized_avg'].round(3)
-
-    # Pivot the data to have dates as columns and variants as rows
-    pivot_df = final_df.pivot(index='Variant', columns='date', values='normalized_avg').fillna(0)
+def read_dates(edited_metadata_file):
+    dates_df = pd.read_csv(edited_metadata_file, dtype=str)
+    dates_df.columns = ["sample", "date"]
+    dates_df["sample"] = dates_df["sample"].str.replace('_freyja_variants.tsv', '', regex=False)
+    return dates_df
+
+def warn_unparsed_dates(samples):
+    # samples whose date is not MM/DD/YYYY are left out of the time series, say which in the log and the report warnings
+    msg = f"sample dates not in MM/DD/YYYY format, left out of the time series plots: {', '.join(samples)} \n"
+    sys.stderr.write(msg)
+    if os.path.isdir("output"):
+        with open("output/warning.txt", "a") as warning_file:
+            warning_file.write(msg.rstrip() + "\n")
+
+def get_periods(dates_df):
+    # parse the MM/DD/YYYY sample dates once and label each sample with its day, epiweek and month
+    dates = pd.to_datetime(dates_df["date"], format="%m/%d/%Y", errors="coerce")
+    unparsed = dates_df.loc[dates.isna(), "sample"].astype(str).tolist()
+    if len(unparsed) != 0:
+        warn_unparsed_dates(unparsed)
+    periods_df = pd.DataFrame({"sample": dates_df["sample"], "date": dates}).dropna(subset=["date"])
+    dates = periods_df["date"]
+    # CDC epiweeks start on Sunday and belong to the year holding their Wednesday, like '2021W16'
+    wednesday = dates + pd.to_timedelta(3 - (dates.dt.dayofweek + 1) % 7, unit="D")
+    periods_df["day"] = dates.dt.strftime("%Y-%m-%d")
+    periods_df["week"] = wednesday.dt.year.astype(str) + "W" + ((wednesday.dt.dayofyear - 1) // 7 + 1).astype(str).str.zfill(2)
+    periods_df["month"] = dates.dt.strftime("%Y/%m")
+    return periods_df.drop(columns="date")
+
+def get_time_series_tables(lineage_df, variant_df, dates_df):
+    # lineages and variants in one long frame, merged with the dates once
+    long_df = pd.concat([
+        lineage_df.rename(columns={"lineage": "name"}).astype({"name": str}).assign(kind="lineage"),
+        variant_df.rename(columns={"variant": "name"}).astype({"name": str}).assign(kind="variant"),
+    ], ignore_index=True)
+    long_df = long_df.astype({"sample": str}).merge(get_periods(dates_df), on="sample")
+    # one row per sample abundance and period type
+    long_df = long_df.melt(id_vars=["kind", "name", "abundance"], value_vars=PERIODS, var_name="period", value_name="x")
+    # all six tables in one groupby
+    grouped = long_df.groupby(["kind", "period", "x", "name"])["abundance"].agg(["sum", "count"]).reset_index()
+    # normalize so the abundances of each date, week and month add up to 1
+    totals = grouped.groupby(["kind", "period", "x"])["sum"].transform("sum")
+    grouped["normalized"] = grouped["sum"] / totals
+    # dates are the average of the normalized sample abundances, as in the original day plots
+    day = grouped["period"] == "day"
+    grouped.loc[day, "normalized"] = grouped.loc[day, "normalized"] / grouped.loc[day, "count"]
+    tables = {}
+    for kind, kind_df in [("lineage", lineage_df), ("variant", variant_df)]:
+        # keep the name order of the input, alphabetical or most abundant first in large cohort mode
+        names = pd.CategoricalDtype(kind_df[kind].cat.categories)
+        for period in PERIODS:
+            table = grouped[(grouped["kind"] == kind) & (grouped["period"] == period)]
+            tables[(kind, period)] = table[["x", "name", "normalized"]].astype({"name": names})
+    return tables
+
+def day_plot(table, legend_title, title, out):
+    # Pivot the data to have dates as columns and lineages or variants as rows
+    pivot_df = table.pivot_table(index='name', columns='x', values='normalized', aggfunc='sum', observed=True).fillna(0)
 
     # Plotly stacked bar plot
     fig = go.Figure()
-    for i, variant in enumerate(pivot_df.index):
+    for i, name in enumerate(pivot_df.index):
         fig.add_trace(go.Bar(
             x=pivot_df.columns,
-            y=pivot_df.loc[variant],
-            name=variant,
-            hovertemplate='<b>{}</b><br>Normalized Avg:%{{y:.2%}}<extra></extra>'.format(variant),
+            y=pivot_df.loc[name],
+            name=name,
+            hovertemplate='<b>{}</b><br>Normalized Avg:%{{y:.2%}}<extra></extra>'.format(name),
             marker_color=colorblind_palette[i % len(colorblind_palette)],  # Use color from predefined palette
         ))
 
     # Update the layout for better visualization
     fig.update_layout(
     barmode='stack',
-    title='Variant Abundance by Date',
+    title=title,
     title_font_size=24,
-    legend_title='Variant',
+    legend_title=legend_title,
     xaxis=dict(
         tickformat='%Y-%m-%d',
         type='category',
-        tickangle=-45, 
+        tickangle=-45,
         tickfont_size=16),
     xaxis_title='Date',
     xaxis_title_font_size=18,
@@ -162,93 +127,19 @@ def day_variant_plot(merged_df, day_variant_out):
         legend_font_size=14,
     hoverlabel=dict(font_size=16, font_family="Arial"),
     height=700)
-    fig.write_html(day_variant_out, include_plotlyjs=False)  # This plot will not work outside of the report
-
-def lineage_day_plot(df, dates_df, day_lineage_out):
-    merged_df = {}
-    formatted_date_list = []
-    df_lineages = get_lineage_info(df)
-    merged_df = pd.merge(df_lineages, dates_df, left_on='sample', right_on='sample')
-    # group rows that have the same sample id together
-    # group sample ids with the same date together 
-    # now that row with the same dates and sample id ar emerged together normalize the data to add up to 1
-    merged_df['normalized'] = merged_df[['date','abundance']].groupby(['date'])['abundance'].transform(lambda x: x / x.sum())    
-    merged_df = merged_df.sort_values(by='date')
-    merged_df["formatted_date"] = pd.to_datetime(merged_df['date']).dt.date
-    # START: merge the samples by date and linage
-    # Break it up by sample and lineage
-    grouped = merged_df.groupby(['formatted_date', 'lineage'])['normalized'].agg(['sum', 'count']).reset_index()
-
-    # Calculate the normalized average by dividing the sum by the count
-    grouped['normalized_avg'] = grouped['sum'] / grouped['count']
-
-    # Select the relevant columns for the final DataFrame
-    final_df = grouped[['formatted_date', 'lineage', 'normalized_avg']]
-
-    # Rename columns for clarity
-    final_df.columns = ['date', 'lineage', 'normalized_avg']
+    fig.write_html(out, include_plotlyjs=False)  # This plot will not work outside of the report
+    return
 
-    # Round values
-    final_df['normalized_avg'].round(3)
-    final_df.sort_values(by=['normalized_avg'], inplace=True)
-    # Pivot the data to have dates as columns and lineages as rows
-    pivot_df = final_df.pivot(index='lineage', columns='date', values='normalized_avg').fillna(0)
+def period_plot(table, xaxis_title, legend_title, title, out):
+    # weeks or months as columns, lineages or variants missing from a period are left out of its bar
+    pivot_df = table.pivot_table(index='name', columns='x', values='normalized', aggfunc='sum', observed=True)
 
-    # Plotly stacked bar plot
     fig = go.Figure()
-    for i, lineage in enumerate(pivot_df.index):
+    for i, name in enumerate(pivot_df.index):
         fig.add_trace(go.Bar(
             x=pivot_df.columns,
-            y=pivot_df.loc[lineage],
-            name=lineage,
-            hovertemplate='<b>{}</b><br>Normalized Avg:%{{y:.2%}}<extra></extra>'.format(lineage),
-            marker_color=colorblind_palette[i % len(colorblind_palette)],  # Use color from predefined palette
-        ))
-
-    # Update the layout for better visualization
-    fig.update_layout(
-    barmode='stack',
-    title='Lineage Abundance by Date',
-    title_font_size=24,
-    legend_title='Lineage',
-    xaxis=dict(
-        tickformat='%Y-%m-%d',
-        type='category',
-        tickangle=-45, 
-        tickfont_size=16),
-    xaxis_title='Date',
-    xaxis_title_font_size=18,
-    yaxis_title='Abundance (%)',
-    yaxis_title_font_size=18,
-    yaxis=dict(
-        tickformat=".0%",
-        tickfont_size=16),
-        legend_title_font_size=16,
-        legend_font_size=14,
-    hoverlabel=dict(font_size=16, font_family="Arial"),
-    height=700)
-    fig.write_html(day_lineage_out, include_plotlyjs=False)  # This plot will not work outside of the report
-    return
-
-def month_lineages_plot(df, dates_df, month_lineage_out):
-    merged_df = {}
-    df_lineages = get_lineage_info(df)
-    merged_df = pd.merge(df_lineages, dates_df, left_on='sample', right_on='sample')
-    # print(merged_df)
-    merged_df['month'] = merged_df['date'].apply(calculate_month)
-    # group rows that have the same sample id together
-    # group sample ids with the same month together 
-    merged_df['normalized'] = merged_df[['month','abundance']].groupby(['month'])['abundance'].transform(lambda x: x / x.sum())
-    # Create a Plotly figure
-    fig = go.Figure()
-    lineages = merged_df['lineage'].unique()
-    for i, lineage in enumerate(lineages):
-        df_subset = merged_df[merged_df['lineage'] == lineage]
-        # color = color_blind_friendly_colors[i % len(color_blind_friendly_colors)]
-        fig.add_trace(go.Bar(
-            x=df_subset['month'],
-            y=df_subset['normalized'],
-            name=lineage,
+            y=pivot_df.loc[name],
+            name=name,
             hoverinfo='y+name',
             hovertemplate='<b>%{x}</b><br>%{y:.2%}<br><b>%{data.name}</b><extra></extra>',
             marker_line_width=0,
@@ -258,14 +149,14 @@ def month_lineages_plot(df, dates_df, month_lineage_out):
     # Update layout for a stacked bar chart
     fig.update_layout(
         barmode='stack',
-        title='Lineage Abundance by Month',
+        title=title,
         title_font_size=24,
-        xaxis_title='Month',
+        xaxis_title=xaxis_title,
         xaxis_title_font_size=18,
         yaxis_title='Abundance (%)',
         yaxis_title_font_size=18,
         yaxis=dict(tickformat=".0%", tickfont_size=16),
-        legend_title='Lineage',
+        legend_title=legend_title,
         legend_title_font_size=16,
         legend_font_size=14,
         xaxis=dict(
@@ -277,149 +168,9 @@ def month_lineages_plot(df, dates_df, month_lineage_out):
         hoverlabel=dict(font_size=16, font_family="Arial"),
         height=700
     )
-    fig.write_html(month_lineage_out, include_plotlyjs=False)  # This plot will not work outside of the report
+    fig.write_html(out, include_plotlyjs=False)  # This plot will not work outside of the report
     return
 
-def month_variant_plot(merged_df, month_variant_out):
-    merged_df['month'] = merged_df['date'].apply(calculate_month)
-    # group rows that have the same sample id together
-    merged_df['normalized'] = merged_df[['month','abundance']].groupby(['month'])['abundance'].transform(lambda x: x / x.sum())
-    # Create a Plotly figure
-    fig = go.Figure()
-    # # changes to atch below 
-    # Add traces
-    variants = merged_df['Variant'].unique()
-    for i, variant in enumerate(variants):
-        df_subset = merged_df[merged_df['Variant'] == variant]
-        fig.add_trace(go.Bar(
-            x=df_subset['month'],
-            y=df_subset['normalized'],
-            name=variant,
-            marker_color=colorblind_palette[i % len(colorblind_palette)], # loop through the color palette
-            hoverinfo='y+name',
-            hovertemplate='<b>%{x}</b><br>%{y:.2%}<br><b>%{data.name}</b><extra></extra>',
-            marker_line_width=0
-        ))
-
-    # Update layout for a stacked bar chart
-    fig.update_layout(
-        barmode='stack',
-        title='Variant Abundance by Month',
-        title_font_size=24,
-        xaxis_title='Month',
-        xaxis_title_font_size=18,
-        yaxis_title='Abundance (%)',
-        yaxis_title_font_size=18,
-        yaxis=dict(tickformat=".0%", tickfont_size=16),
-        legend_title='Variant',
-        legend_title_font_size=16,
-        legend_font_size=14,
-        xaxis=dict(
-            type='category',
-            categoryorder='category ascending',
-            tickangle=-45,
-            tickfont_size=16
-        ),
-        hoverlabel=dict(font_size=16, font_family="Arial"),
-        height=700
-        )
-    fig.write_html(month_variant_out, include_plotlyjs=False)  # This plot will not work outside of the report
-    return
-
-def week_lineages_plot(df, dates_df, week_lineage_out):
-    merged_df = {}
-    df_lineages = get_lineage_info(df)
-    merged_df = pd.merge(df_lineages, dates_df, left_on='sample', right_on='sample')
-    merged_df['epiweek'] = merged_df['date'].apply(calculate_epiweek)
-    # group rows that have the same sample id together
-    # group sample ids with the same date together 
-    merged_df['normalized'] = merged_df[['epiweek','abundance']].groupby(['epiweek'])['abundance'].transform(lambda x: x / x.sum())
-    fig = go.Figure()
-    lineages = merged_df['lineage'].unique()
-    for i, lineage in enumerate(lineages):
-        df_subset = merged_df[merged_df['lineage'] == lineage]
-        fig.add_trace(go.Bar(
-            x=df_subset['epiweek'],
-            y=df_subset['normalized'],
-            name=lineage,
-            hoverinfo='y+name',
-            hovertemplate='<b>%{x}</b><br>%{y:.2%}<br><b>%{data.name}</b><extra></extra>',
-            marker_line_width=0,
-            marker_color=colorblind_palette[i % len(colorblind_palette)] # loop through the color palette
-        ))
-
-    # Update layout for a stacked bar chart
-    fig.update_layout(
-        barmode='stack',
-        title='Lineage Abundance by Week',
-        title_font_size=24,
-        xaxis_title='Epiweek',
-        xaxis_title_font_size=18,
-        yaxis_title='Abundance (%)',
-        yaxis_title_font_size=18,
-        yaxis=dict(tickformat=".0%", tickfont_size=16),
-        legend_title='Lineage',
-        legend_title_font_size=16,
-        legend_font_size=14,
-        xaxis=dict(
-            type='category',
-            categoryorder='category ascending',
-            tickangle=-45,
-            tickfont_size=16
-        ),
-        hoverlabel=dict(font_size=16, font_family="Arial"),
-        height=700
-        )
-    fig.write_html(week_lineage_out, include_plotlyjs=False)  # This plot will not work outside of the report
-    return
-
-def week_variant_plot(merged_df, week_variant_out):
-    merged_df['epiweek'] = merged_df['date'].apply(calculate_epiweek)
-    # group rows that have the same sample id together
-    # group sample ids with the same epiweek together 
-    # varaints will group together
-    merged_df['normalized'] = merged_df[['epiweek','abundance']].groupby(['epiweek'])['abundance'].transform(lambda x: x / x.sum())
-
-    # Create a Plotly figure
-    fig = go.Figure()
-    # Add traces
-    variants = merged_df['Variant'].unique()
-    for i, variant in enumerate(variants):
-        df_subset = merged_df[merged_df['Variant'] == variant]
-        fig.add_trace(go.Bar(
-            x=df_subset['epiweek'],
-            y=df_subset['normalized'],
-            name=variant,
-            marker_color=colorblind_palette[i % len(colorblind_palette)], # loop through the color palette
-            hoverinfo='y+name',
-            hovertemplate='<b>%{x}</b><br>%{y:.2%}<br><b>%{data.name}</b><extra></extra>',
-            marker_line_width=0
-        ))
-
-    # Update layout for a stacked bar chart
-    fig.update_layout(
-        barmode='stack',
-        title='Variant Abundance by Week',
-        title_font_size=24,
-        xaxis_title='Epiweek',
-        xaxis_title_font_size=18,
-        yaxis_title='Abundance (%)',
-        yaxis_title_font_size=18,
-        yaxis=dict(tickformat=".0%", tickfont_size=16),
-        legend_title='Variant',
-        legend_title_font_size=16,
-        legend_font_size=14,
-        xaxis=dict(
-            type='category',
-            categoryorder='category ascending',
-            tickangle=-45,
-            tickfont_size=16
-        ),
-        hoverlabel=dict(font_size=16, font_family="Arial"),
-        height=700
-        )
-    fig.write_html(week_variant_out, include_plotlyjs=False)  # This plot will not work outside of the report
-
 def main(argv):
     # step 0 get paths set up
     freyja_results = argv[1]
@@ -430,29 +181,27 @@ def main(argv):
     week_variant_out = argv[6]
     month_lineage_out = argv[7]
     month_variant_out = argv[8]
+    # large cohort mode: lineages.yml and the number of lineages to keep
+    lineages_yml = argv[9] if len(argv) > 10 else None
 
-    df = pd.read_csv(freyja_results, sep="\t")
-    df.columns = ["sample", "summarized", "lineages", "abundances", "resid","coverage"]
-    # chop off the file name and extension 
-    df["sample"] = df["sample"].apply(lambda x: x.replace('_freyja_variants.tsv', ''))
+    df = read_freyja_results(freyja_results)
+    top_lineages = int(argv[10]) if lineages_yml else None
+    lineage_df, variant_df = get_plot_frames(df, lineages_yml, top_lineages)
     if os.path.isfile(edited_metadata_file):
-        dates_df = pd.read_csv(edited_metadata_file)
-        dates_df.columns = ["sample", "date"]
-        if len(dates_df["date"]) >= 1:
-            dates_df["sample"] = dates_df["sample"].apply(lambda x: x.replace('_freyja_variants.tsv', ''))
+        dates_df = read_dates(edited_metadata_file)
+        tables = get_time_series_tables(lineage_df, variant_df, dates_df)
         # linage day
-        lineage_day_plot(df, dates_df, day_lineage_out)
+        day_plot(tables[("lineage", "day")], 'Lineage', 'Lineage Abundance by Date', day_lineage_out)
         # variant day
-        v_day = get_variant_day_info(df, dates_df)
-        day_variant_plot(v_day,day_variant_out)
+        day_plot(tables[("variant", "day")], 'Variant', 'Variant Abundance by Date', day_variant_out)
         # lineage week
-        week_lineages_plot(df, dates_df, week_lineage_out)
+        period_plot(tables[("lineage", "week")], 'Epiweek', 'Lineage', 'Lineage Abundance by Week', week_lineage_out)
         # variant week
-        week_variant_plot(v_day, week_variant_out)
+        period_plot(tables[("variant", "week")], 'Epiweek', 'Variant', 'Variant Abundance by Week', week_variant_out)
         # lineage month
-        month_lineages_plot(df, dates_df, month_lineage_out)
-        # # variant month
-        month_variant_plot(v_day, month_variant_out)
+        period_plot(tables[("lineage", "month")], 'Month', 'Lineage', 'Lineage Abundance by Month', month_lineage_out)
+        # variant month
+        period_plot(tables[("variant", "month")], 'Month', 'Variant', 'Variant Abundance by Month', month_variant_out)
         # print('Time series stacked bar plots generated')
 if __name__ == "__main__":
     main(sys.argv)
@@ -4,48 +4,64 @@ import os
 import pandas as pd
 import re
 
-# find assembly plots ending in detail.png
-def find_assembly_plots(directory):
-    assembly_plots = []
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for filename in filenames:
-            if filename.lower().endswith('detail.png'):  # Ensures case insensitivity
-                full_path = os.path.join(dirpath, filename)
-                assembly_plots.append(full_path)
-    return assembly_plots
+from job_state import JobState
+
+# assembly coverage plot thumbnails written by report_thumbnails.py
+def read_thumbnails(manifest_path):
+    if not os.path.exists(manifest_path):
+        return pd.DataFrame(columns=["sample", "image", "thumbnail"])
+    thumbnails_df = pd.read_csv(manifest_path, sep="\t", dtype=str, keep_default_na=False)
+    return thumbnails_df[thumbnails_df["status"] == "complete"]
+
+def generate_thumbnail_html(sample, image_path, thumbnail_path, output_dir):
+    # inline thumbnail linking to the full size plot, which sits next to the report in the job output
+    base64_string = image_to_base64(thumbnail_path)
+    image_type = os.path.splitext(thumbnail_path)[1].lstrip(".").lower()
+    image_link = os.path.relpath(os.path.abspath(image_path), os.path.abspath(output_dir))
+    return (f'<div class="image-container"><a href="{image_link}" target="_blank">'
+            f'<img src="data:image/{image_type};base64,{base64_string}" alt="{sample} coverage plot" title="{sample}" loading="lazy"></a></div>')
 
 def generate_progress_cell(value):
     # Check if the value is "Complete" or "Incomplete"
     if value == "Complete":
         color = "lightgreen; opacity: 0.7"
-    elif value == "Incomplete":
+    elif value in ("Incomplete", "Failed preflight"):
         color = "lightcoral; opacity: 0.7"
     else:
         color = "transparent"  # No color for other values
     return f'<td style="background-color: {color}; color: black;">{value}</td>'
 
-def generate_progress_table_html(df):
-    # Generate table headers
-    headers = ''.join(f'<th>{header}</th>' for header in df.columns)
-    
-    # Generate table rows
-    rows = ''.join(
-        f'<tr>{"".join(generate_progress_cell(row[column]) for column in df.columns)}</tr>'
-        for _, row in df.iterrows()
-    )
-    return headers, rows
+def generate_progress_row_html(row):
+    return f'<tr>{"".join(generate_progress_cell(value) for value in row)}</tr>'
 
 # Function to generate the HTML table rows
-def generate_table_html(df):
-    # Generate table headers
-    headers = ''.join(f'<th>{header}</th>' for header in df.columns)
+def generate_table_row_html(row):
+    return f'<tr>{" ".join(f"<td>{value}</td>" for value in row)}</tr>'
 
-    # Generate table rows
-    rows = ''.join(
-        f'<tr>{" ".join(f"<td>{row[column]}</td>" for column in df.columns)}</tr>'
-        for _, row in df.iterrows()
-    )
-    return headers, rows
+def json_value(value):
+    # numpy scalars as python values, NaN as null
+    if pd.isna(value):
+        return None
+    return value.item() if hasattr(value, "item") else value
+
+def write_table(fh, df, table_id, virtual, progress=False):
+    # small tables are written row by row as html, large ones as compact json shown by report_tables.js
+    headers = ''.join(f'<th>{header}</th>' for header in df.columns)
+    if not virtual:
+        fh.write(f'<table><thead><tr>{headers}</tr></thead><tbody>')
+        for row in df.itertuples(index=False):
+            fh.write(generate_progress_row_html(row) if progress else generate_table_row_html(row))
+        fh.write('</tbody></table>')
+        return
+    fh.write(f'<div class="virtual-table" data-table="{table_id}"{" data-progress" if progress else ""}>'
+        f'<input type="search" placeholder="Filter by {df.columns[0]}"> <span class="virtual-table-count"></span>'
+        f'<div class="virtual-table-scroll"><table><thead><tr>{headers}</tr></thead><tbody></tbody></table></div></div>')
+    fh.write(f'<script type="application/json" id="{table_id}">{{"rows":[')
+    for i, row in enumerate(df.itertuples(index=False)):
+        # keep a value from closing the script tag
+        row_json = json.dumps([json_value(value) for value in row]).replace("</", "<\\/")
+        fh.write(f'{"," if i else ""}{row_json}')
+    fh.write(']}</script>')
 
 def image_to_base64(file_path):
     """Read binary file and return base64-encoded string"""
@@ -69,11 +85,94 @@ def read_plotly_html(plot_path):
 
     # Assuming extracted_content contains our needed Plotly graph initialization scripts
     plotly_graph_content = extracted_content[0] if extracted_content else ''
+    # report_plots.js runs the plot script when the plot scrolls into view
+    plotly_graph_content = re.sub(r'<script(?: type="text/javascript")?>', '<script type="text/x-lazy-plot">', plotly_graph_content)
     return plotly_graph_content
 
-def write_html_report(workflow_dir):
+def write_thumbnails(fh, thumbnails_df, output_dir):
+    # Add the Base64 thumbnail of each coverage plot, linked to the full size plot
+    for sample, image_path, thumbnail_path in zip(thumbnails_df["sample"], thumbnails_df["image"], thumbnails_df["thumbnail"]):
+        fh.write(generate_thumbnail_html(sample, image_path, thumbnail_path, output_dir))
+
+def write_plot_section(fh, header, description, variant_plot, lineage_plot, report_data, state):
+    # collapsed section with the variant (left) and lineage (right) plots
+    if not has_plot(lineage_plot, report_data, state):
+        return
+    fh.write(f"""
+            <details class="plot-section">
+                <summary>{header}</summary>
+                {description}
+                <div class="plot-container">
+                    <div class="plot">
+                        """)
+    write_plot(fh, variant_plot, report_data, state)
+    fh.write("""
+                    </div>
+                    <div class="plot">
+                        """)
+    write_plot(fh, lineage_plot, report_data, state)
+    fh.write("""
+                    </div>
+                </div>
+            </details>""")
+
+def read_report_data(report_data_path, state):
+    # figures of the compact dataset written by render_plots.py --report-data, None when the report embeds the plotly html
+    if not state.exists(report_data_path):
+        return None
+    with open(report_data_path, 'r') as file:
+        return {"path": report_data_path, "figures": set(json.load(file)["figures"])}
+
+def has_plot(plot_path, report_data, state):
+    figure = os.path.splitext(os.path.basename(plot_path))[0]
+    return state.exists(plot_path) or (report_data is not None and figure in report_data["figures"])
+
+def write_plot(fh, plot_path, report_data, state):
+    # the plotly html of the plot, or an empty div report_plots.js fills from the compact dataset
+    if state.exists(plot_path):
+        fh.write(read_plotly_html(plot_path))
+    elif has_plot(plot_path, report_data, state):
+        figure = os.path.splitext(os.path.basename(plot_path))[0]
+        fh.write(f'<div data-figure="{figure}" style="height:700px; width:100%;"></div>')
+
+def write_escaped_json(fh, json_path, chunk_size=1 << 20):
+    # copy a json file into a script tag in chunks, keeping "</" in a value from closing the tag
+    with open(json_path, 'r') as file:
+        carry = ""
+        for chunk in iter(lambda: file.read(chunk_size), ""):
+            chunk = carry + chunk
+            # a "<" at the end of the chunk could start a "</" in the next one
+            carry = "<" if chunk.endswith("<") else ""
+            fh.write(chunk[:len(chunk) - len(carry)].replace("</", "<\\/"))
+        fh.write(carry)
+
+def write_report_scripts(fh, workflow_dir, report_data, virtual_tables):
+    # the scripts rendering the plots as they come into view and the large tables, with the compact dataset embedded once
+    if report_data is not None:
+        fh.write('<script id="report-data" type="application/json">')
+        write_escaped_json(fh, report_data["path"])
+        fh.write('</script>\n')
+    script_names = ["report_plots.js"] + (["report_tables.js"] if virtual_tables else [])
+    for script_name in script_names:
+        with open(os.path.join(workflow_dir, "scripts", script_name), 'r') as file:
+            fh.write(f'<script>{file.read()}</script>\n')
+
+def write_template(fh, template, writers, **fields):
+    # format the small fields of the template, then write it piece by piece
+    # with each large section streamed to the file by its writer in place of {name}
+    markers = {name: f"\0{name}\0" for name in writers}
+    pieces = re.split("\0(\\w+)\0", template.format(**fields, **markers))
+    for i, piece in enumerate(pieces):
+        if i % 2:
+            writers[piece](fh)
+        else:
+            fh.write(piece)
+
+def write_html_report(workflow_dir, output_dir, html_report_path, large_table_rows):
     ## read in the job stats
     job_stats_df = pd.read_csv("output/job_stats.tsv", sep="\t", header=0)
+    # which plots the job wrote, from the job state manifest
+    state = JobState()
     # Define the columns for analysis profress dataframe
     progress_cols = ['Sample ID', 'Assembly', 'Freyja - Analysis', 'Freyja - Visualization']
     # Define the columns for the asssembly stats
@@ -81,14 +180,15 @@ def write_html_report(workflow_dir):
                 'Depth Minimum', 'Depth Maximum', 'Total N Count', 'N Blocks',
                 'Fasta Length', 'Primers', 'Primer Count', 'Mapped Reads',
                 'Unmapped Reads', 'Primer Trim Count', 'Percentage of Primers Trimmed',
-                'Variant Count']
+                'Variant Count', 'Total Alignments', 'Percentage Mapped', 'Percentage Properly Paired',
+                'Duplicates', 'Secondary Alignments', 'Supplementary Alignments',
+                'Coverage Breadth 1x (%)', 'Coverage Breadth 10x (%)']
     # Create the progress DataFrame
     assembly_progress_df = job_stats_df[progress_cols]
     # Create the assembly DataFrame
     stats_df = job_stats_df[sats_cols]
-    # Extract table data from dataframe
-    assembly_table_headers, assembly_table_rows = generate_progress_table_html(assembly_progress_df)
-    stats_table_headers, stats_table_rows = generate_table_html(stats_df)
+    # large jobs show the tables with a virtualized client side table instead of one html row per sample
+    virtual_tables = len(job_stats_df) >= large_table_rows
     # set up the logo
     bvbrc_logo_path = os.path.join(workflow_dir, "bv-brc-header-logo-bg.png")
     base64_string = image_to_base64(bvbrc_logo_path)
@@ -101,67 +201,60 @@ def write_html_report(workflow_dir):
     else:
         warning_header="<h3>Analysis Warnings</h4>"
         warning_text="No warnings were generated during your analysis."
+    # coverage panel of every sample, the per sample assembly plots are collapsed below it
+    coverage_plot = "plots/coverage_plot.html"
+    coverage_panel_description, coverage_images_header, coverage_images_footer = (
+        ("<p>The panel below shows the sequencing depth along the Wuhan-Hu-1 reference genome for every sample, from the \
+            Freyja depths. Each track is downsampled to a few hundred points that keep its peaks and dropouts. Hover over \
+            a track for the depth at a position, click a sample in the legend to hide it or double click it to show only \
+            that sample, and switch the depth axis between linear and log scale with the buttons.</p>",
+        '<details class="plot-section"><summary><h3>Coverage Plots per Sample</h3></summary>',
+        "</details>")
+        if state.exists(coverage_plot) else
+        ("", "", "")
+    )
     # assembly plots
-    image_paths = find_assembly_plots("assembly_images")
+    thumbnails_df = read_thumbnails("report_images/thumbnails.tsv")
     #set up the barcodes
     barcode_version=read_barcode_version("barcode_version.txt")
 
-    # set up the freyja plots 
+    # set up the freyja plots, large jobs embed one compact dataset instead of the plotly html files
+    report_data = read_report_data("plots/report_data.json", state)
     lineage_plot = "plots/lineages_plot.html"
     variant_plot = "plots/variants_plot.html"
 
-    standard_plot_header, standard_plot_description, standard_lineage_plot, standard_variant_plot = (
+    standard_plot_header, standard_plot_description = (
         ("<h3>Lineage and Variant Abundance by Sample</h3>",
-        "<p>Below are stacked bar graphs showing the relative abundance of variants (left) and lineages (right) across the samples.<p>",
-        read_plotly_html(lineage_plot),
-        read_plotly_html(variant_plot))
-        if os.path.exists(lineage_plot) else
-        ("", "", "", "")
+        "<p>Below are stacked bar graphs showing the relative abundance of variants (left) and lineages (right) across the samples.<p>")
+        if has_plot(lineage_plot, report_data, state) else
+        ("", "")
     )
     # Time series plots - Day
     lineage_day = "plots/lineages_by_day_plot.html"
     variant_day = "plots/variants_by_day_plot.html"
-    time_series_header, day_plot_header, day_plot_description, day_lineage_plot, day_variant_plot = (
-        ("<h3>Time Series Plots</h3>",
-        "<h3>Lineage and Variant Abundance by Date</h3>",
-        "<p>Below are the smoothed stacked bar graphs showing the relative abundance \
+    # the time series sections are only written when their plots exist
+    day_plot_header = "<h3>Lineage and Variant Abundance by Date</h3>"
+    day_plot_description = "<p>Below are the smoothed stacked bar graphs showing the relative abundance \
             of variants (left) and lineages (right) by date, generated by aggregating the results from one or more \
             samples collected on the same date. This plot may help reveal short-term variations and spikes in data \
-            that might be linked to specific events or daily human activities.</p>",
-        read_plotly_html(lineage_day),
-        read_plotly_html(variant_day))
-        if os.path.exists(lineage_day) else
-        ("", "", "", "", "")
-    )
+            that might be linked to specific events or daily human activities.</p>"
     # Time series plots - Week
     lineage_week = "plots/lineages_by_week_plot.html"
     variant_week = "plots/variants_by_week_plot.html"
-    week_plot_header, week_plot_description, week_lineage_plot, week_variant_plot = (
-        ("<h3>Lineage and Variant Abundance by Week</h3>",
-        "<p>The stacked bar graphs below show the relative abundance of variants (left) and \
+    week_plot_header = "<h3>Lineage and Variant Abundance by Week</h3>"
+    week_plot_description = "<p>The stacked bar graphs below show the relative abundance of variants (left) and \
             lineages (right) by epiweek, generated by aggregating the results from one or more samples collected in the \
             same epiweek. An 'epiweek', short for epidemiological week, is a standard method of grouping days into weeks \
             for the purposes of public health and epidemiological tracking. An epiweek serves to create a consistent and \
             comparable method of collecting and analyzing data across different time periods and regions. An epiweek \
-            typically begins on a Sunday and ends on a Saturday, consisting of seven days in total.<p>",
-        read_plotly_html(lineage_week),
-        read_plotly_html(variant_week))
-        if os.path.exists(lineage_week) else
-        ("", "", "", "")
-    )
+            typically begins on a Sunday and ends on a Saturday, consisting of seven days in total.<p>"
     # Time series plots - month
     lineage_month = "plots/lineages_by_month_plot.html"
     variant_month = "plots/variants_by_month_plot.html"
-    month_plot_header, month_plot_description, month_lineage_plot, month_variant_plot = (
-        ("<h3>Lineage and Variant Abundance by Month</h3>",
-        "<p>The stacked bar graphs below show the relative abundance of variants (left) and \
-            lineages (right), aggregated by collection month.</p>",
-        read_plotly_html(lineage_month),
-        read_plotly_html(variant_month))
-        if os.path.exists(lineage_month) else
-        ("", "", "", "")
-    )
-    ### write the report HTML ###
+    month_plot_header = "<h3>Lineage and Variant Abundance by Month</h3>"
+    month_plot_description = "<p>The stacked bar graphs below show the relative abundance of variants (left) and \
+            lineages (right), aggregated by collection month.</p>"
+    ### write the report HTML section by section ###
     html_template = """
         <!DOCTYPE html>
         <html lang="en">
@@ -192,6 +285,13 @@ def write_html_report(workflow_dir):
                     table, th, td {{ border: 1px solid black; border-collapse: collapse; }}
                     th, td {{ padding: 5px; text-align: left; }}
                     img {{ width: 100%; max-width: 600px; height: auto; }}
+                    .virtual-table-scroll {{
+                        max-height: 600px; /* Only the rows scrolled into view are in the page */
+                        overflow-y: auto;
+                        margin-top: 5px;
+                    }}
+                    .virtual-table th {{ position: sticky; top: 0; background-color: white; }}
+                    .virtual-table td {{ white-space: nowrap; }}
                     .image-row {{
                         display: flex;
                         flex-wrap: wrap;
@@ -243,32 +343,14 @@ def write_html_report(workflow_dir):
                 reads and variant calling, Freyja - Analysis, and Freyja - Visualization. If a sample is labeled as incomplete for \
                 any of the stages, please refer to the assembly and alignment statistics table in the following section or the \
                 warnings at the end of the report.</p>
-                <table>
-                    <thead>
-                        <tr>
-                            {assembly_table_headers}
-                        </tr>
-                    </thead>
-                    <tbody>
-                        {assembly_table_rows}
-                    </tbody>
-                </table>
+                {assembly_table}
                 <br>
                 <!-- Assembly results CSV Table -->
                 <h3>Primer Trimming and Alignment Statistics</h4>
                 <p>The following table provides and overview of the key statistics from the primer trimming, removal of low-quality \
                 sequence, alignment to the Wuhan-Hu-1 reference genome, and variant calling. Please refer to the user guide for a \
                 detailed description of the values in the table.</p>
-                <table>
-                    <thead>
-                        <tr>
-                            {stats_table_headers}
-                        </tr>
-                    </thead>
-                    <tbody>
-                        {stats_table_rows}
-                    </tbody>
-                </table>
+                {stats_table}
                 <p>The columns are as follows<p>
                 <ul>
                     <li><strong>Depth Mean, Median, and Standard Deviation</strong>: These statistics describe the average \
@@ -296,27 +378,30 @@ def write_html_report(workflow_dir):
                         were removed during data cleanup to reduce errors and the percentage of total primers this count represents.</li>
                     <br>
                     <li><strong>Variant Count</strong>: The total number of different viral SARS-CoV-2 variants identified in the sample.</li>
+                    <br>
+                    <li><strong>Total Alignments, Percentage Mapped and Percentage Properly Paired</strong>: From samtools flagstat, \
+                        the number of alignments in the sample BAM file, the percentage of them aligned to the reference genome and \
+                        the percentage of paired reads aligned as a proper pair.</li>
+                    <br>
+                    <li><strong>Duplicates, Secondary and Supplementary Alignments</strong>: Alignments flagged as duplicates, \
+                        additional alignments of a read to other positions and split alignments of a read, from samtools flagstat.</li>
+                    <br>
+                    <li><strong>Coverage Breadth 1x and 10x</strong>: The percentage of reference genome positions covered by at \
+                        least 1 and at least 10 reads.</li>
                 </ul>
                 <br>
                 <h3>Coverage Plots</h3>
+                {coverage_panel_description}
+                {coverage_panel}
+                {coverage_images_header}
                 <p>Below are the coverage plots for each sample. The X-axis represents the positions along the reference genome and the Y-axis \
                 shows the sequencing depth or coverage at each position. The plots show areas of high and low coverage relative to the \
-                Wuhan-hu-1 reference genome.  Note: that wastewater consensus sequences generated from this workflow are likely to contain a mixture of variants.<p>
+                Wuhan-hu-1 reference genome.  Note: that wastewater consensus sequences generated from this workflow are likely to contain a mixture of variants. \
+                Click a plot to open it at full size.<p>
                 <div class="image-row">
-    """.format(
-        bvbrc_logo_base64=bvbrc_logo_base64,
-        assembly_table_headers=assembly_table_headers,
-        assembly_table_rows=assembly_table_rows,
-        stats_table_headers=stats_table_headers,
-        stats_table_rows=stats_table_rows,
-        )
-    # Loop over each image path, convert to Base64, and add an <img> tag to the HTML
-    for image_path in image_paths:
-        base64_string = image_to_base64(image_path)
-        img_tag = f'<div class="image-container"><img src="data:image/png;base64,{base64_string}" alt="Embedded Image"></div>'
-        html_template += img_tag
-    html_template += """
+                {coverage_thumbnails}
             </div>
+            {coverage_images_footer}
         </body>
         </html>"""
     second_half = """
@@ -333,6 +418,12 @@ def write_html_report(workflow_dir):
                 .plot {{
                         width: 50%; /* Each plot takes up half of the container width */
                     }}
+                    .plot-section > summary {{
+                        cursor: pointer;
+                    }}
+                    .plot-section > summary h3 {{
+                        display: inline-block; /* Keep the header next to the expand marker */
+                    }}
                     .caption {{
                         text-align: center;
                         font-size: 14px;
@@ -371,42 +462,15 @@ def write_html_report(workflow_dir):
             {standard_plot_description}
             <div class="plot-container">
                 <div class="plot" id="plot1">
-                    {standard_variant_plot} <!-- Direct embedding of the plot content -->
-                </div>
-                <div class="plot" id="plot2">
-                    {standard_lineage_plot} <!-- Direct embedding of the plot content -->
-                </div>
-            </div>
-            {day_plot_header}
-            {day_plot_description}
-            <div class="plot-container">
-                <div class="plot" id="plot1">
-                    {day_variant_plot} <!-- Direct embedding of the plot content -->
-                </div>
-                <div class="plot" id="plot2">
-                    {day_lineage_plot} <!-- Direct embedding of the plot content -->
-                </div>
-            </div>
-            {week_plot_header}
-            {week_plot_description}
-            <div class="plot-container">
-                <div class="plot" id="plot1">
-                    {week_variant_plot} <!-- Direct embedding of the plot content -->
-                </div>
-                <div class="plot" id="plot2">
-                    {week_lineage_plot} <!-- Direct embedding of the plot content -->
-                </div>
-            </div>
-            {month_plot_header}
-            {month_plot_description}
-            <div class="plot-container">
-                <div class="plot" id="plot1">
-                    {month_variant_plot} <!-- Direct embedding of the plot content -->
+                    {standard_variant_plot}
                 </div>
                 <div class="plot" id="plot2">
-                    {month_lineage_plot} <!-- Direct embedding of the plot content -->
+                    {standard_lineage_plot}
                 </div>
             </div>
+            {day_plot_section}
+            {week_plot_section}
+            {month_plot_section}
             <h3>Barcode Version</h3>
             <p>Freyja uses lineage-determining mutational "barcodes" derived from the UShER global phylogenetic \
             tree as a basis set to solve the constrained (unit sum, non-negative) de-mixing problem. The barcodes \
@@ -430,43 +494,47 @@ def write_html_report(workflow_dir):
         
             <li>Karthikeyan, S., Levy, J.I., De Hoff, P. et al. Wastewater sequencing reveals early cryptic SARS-CoV-2 variant transmission. Nature 609, 101–108 (2022). https://doi.org/10.1038/s41586-022-05049-6</a></li>
             <ol>
+            {report_plots_script}
         </body>
         </html>
-    """.format(
-        barcode_version=barcode_version,
-        standard_plot_header=standard_plot_header,
-        standard_plot_description=standard_plot_description,
-        standard_variant_plot=standard_variant_plot,
-        standard_lineage_plot = standard_lineage_plot,
-        time_series_header=time_series_header,
-        day_plot_header=day_plot_header, 
-        day_plot_description=day_plot_description,
-        day_variant_plot=day_variant_plot,
-        day_lineage_plot=day_lineage_plot,
-        week_plot_header=week_plot_header,
-        week_plot_description=week_plot_description,
-        week_lineage_plot=week_lineage_plot,
-        week_variant_plot=week_variant_plot,
-        month_plot_header=month_plot_header,
-        month_plot_description=month_plot_description,
-        month_lineage_plot=month_lineage_plot,
-        month_variant_plot=month_variant_plot,
-        warning_header=warning_header,
-        warning_text=warning_text,
+    """
+    # the plots, tables and images are streamed to the report, only one of them is held in memory at a time
+    with open(html_report_path, 'w') as fh:
+        write_template(fh, html_template, {
+            "assembly_table": lambda fh: write_table(fh, assembly_progress_df, "progress-table-data", virtual_tables, progress=True),
+            "stats_table": lambda fh: write_table(fh, stats_df, "stats-table-data", virtual_tables),
+            "coverage_panel": lambda fh: write_plot(fh, coverage_plot, None, state),
+            "coverage_thumbnails": lambda fh: write_thumbnails(fh, thumbnails_df, output_dir),
+            },
+            bvbrc_logo_base64=bvbrc_logo_base64,
+            coverage_panel_description=coverage_panel_description,
+            coverage_images_header=coverage_images_header,
+            coverage_images_footer=coverage_images_footer,
+        )
+        write_template(fh, second_half, {
+            "standard_variant_plot": lambda fh: write_plot(fh, variant_plot, report_data, state),
+            "standard_lineage_plot": lambda fh: write_plot(fh, lineage_plot, report_data, state),
+            # the time series sections start collapsed, their plots are rendered when expanded
+            "day_plot_section": lambda fh: write_plot_section(fh, day_plot_header, day_plot_description, variant_day, lineage_day, report_data, state),
+            "week_plot_section": lambda fh: write_plot_section(fh, week_plot_header, week_plot_description, variant_week, lineage_week, report_data, state),
+            "month_plot_section": lambda fh: write_plot_section(fh, month_plot_header, month_plot_description, variant_month, lineage_month, report_data, state),
+            "report_plots_script": lambda fh: write_report_scripts(fh, workflow_dir, report_data, virtual_tables),
+            },
+            barcode_version=barcode_version,
+            standard_plot_header=standard_plot_header,
+            standard_plot_description=standard_plot_description,
+            warning_header=warning_header,
+            warning_text=warning_text,
         )
-    return html_template, second_half
 # step 0 get paths set up
 with open("config.json", 'r') as file:
         config = json.load(file)
 output_dir = config["output_data_dir"]
 workflow_dir = config["workflow_dir"]
 
-html_template, second_half = write_html_report(workflow_dir)
-
 html_report_path = os.path.join(output_dir, "SARS2Wastewater_report.html")
-with open(html_report_path, 'w') as file:
-    file.write(html_template)
-    file.write(second_half)
+# from this many samples the tables are virtualized, like the large cohort plots
+write_html_report(workflow_dir, output_dir, html_report_path, config.get("large_cohort_samples", 200))
 print(f"Generated HTML report at {html_report_path}.")
 
 
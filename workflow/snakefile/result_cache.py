@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+#
+# Persistent per-sample result cache shared between wastewater jobs.
+# Entries are keyed by a hash of the sample's reads and every setting that
+# changes its results, so a resubmitted sample restores its assembly and
+# Freyja results instead of running sars2-onecodex and freyja again.
+# Other jobs store and evict entries at the same time: an entry is only ever
+# renamed into or out of place, and a restore or a size scan that finds its
+# entry gone counts it as a miss.
+#
+
+# (name in the cache entry, path in the job directory) in the order the files
+# are produced, restoring in this order keeps each output newer than its input
+CACHED_FILES = [
+    ("reference_trimmed.fa", "output/{sample}/assembly/reference_trimmed.fa"),
+    ("ivar.bam", "output/{sample}/assembly/{sample}.ivar.bam"),
+    ("sorted.bam", "output/{sample}/assembly/{sample}.sorted.bam"),
+    ("statistics.tsv", "output/{sample}/assembly/{sample}.statistics.tsv"),
+    ("detail.png", "output/{sample}/assembly/{sample}.detail.png"),
+    ("freyja_variants.tsv", "output/{sample}/freyja/{sample}_freyja_variants.tsv"),
+    ("freyja.depths", "output/{sample}/freyja/{sample}_freyja.depths"),
+    ("freyja_result.tsv", "output/{sample}/freyja/{sample}_freyja_result.tsv"),
+]
+
+# job parameters that change the assembly or Freyja results
+RESULT_PARAMS = [
+    "minimum_base_quality_score",
+    "minimum_lineage_abundance",
+    "coverage_estimate",
+    "minimum_coverage_depth",
+    "confirmedonly",
+]
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def tool_versions():
+    # freyja reports its version, sars2-onecodex is identified by the hash of the script on the PATH
+    try:
+        freyja = subprocess.run(["freyja", "--version"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        freyja = None
+    sars2_onecodex = shutil.which("sars2-onecodex")
+    return {
+        "freyja": freyja,
+        "sars2-onecodex": file_sha256(sars2_onecodex) if sars2_onecodex else None,
+    }
+
+
+def sample_cache_key(lib, read_hashes, config, reference_hashes, tools):
+    key = {
+        "layout": lib["layout"],
+        "reads": read_hashes,
+        "primers": lib.get("primers"),
+        "primer_version": lib.get("primer_version"),
+        "params": {param: config["params"].get(param) for param in RESULT_PARAMS},
+        "references": reference_hashes,
+        "tools": tools,
+    }
+    # downsampled samples are assembled from fewer reads, jobs without downsampling keep their keys
+    if config.get("downsample_depth"):
+        key["downsampling"] = [int(config["downsample_depth"]), int(config.get("downsample_seed", 0))]
+    # likewise the demix solver options only enter the key when they differ from freyja's defaults
+    demix_options = [float(config.get("demix_adapt", 0.0)), float(config.get("demix_a_eps", 1e-8))]
+    if demix_options != [0.0, 1e-8]:
+        key["demix_options"] = demix_options
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def cache_entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def restore_sample(cache_dir, key, sample):
+    entry = cache_entry_dir(cache_dir, key)
+    if not all(os.path.isfile(os.path.join(entry, name)) for name, dest in CACHED_FILES):
+        return False
+    restored = []
+    try:
+        for name, dest in CACHED_FILES:
+            dest = dest.format(sample=sample)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            restored.append(dest)
+            if name == "freyja_result.tsv":
+                # the demix result is labeled with the variants file of the sample it was computed for
+                with open(os.path.join(entry, name)) as src:
+                    lines = src.readlines()
+                lines[0] = f"\t{sample}_freyja_variants.tsv\n"
+                with open(dest, "w") as out:
+                    out.writelines(lines)
+            else:
+                shutil.copyfile(os.path.join(entry, name), dest)
+        # mark the entry as recently used for the LRU eviction
+        os.utime(entry)
+    except OSError as e:
+        # evicted by another job while it was copied, the sample is computed again
+        for dest in restored:
+            if os.path.exists(dest):
+                os.remove(dest)
+        msg = f"result cache: entry for {sample} went away during the restore, counted as a miss: {e} \n"
+        sys.stderr.write(msg)
+        return False
+    return True
+
+
+def store_sample(cache_dir, key, sample):
+    entry = cache_entry_dir(cache_dir, key)
+    if os.path.isdir(entry):
+        return False
+    if not all(os.path.isfile(dest.format(sample=sample)) for name, dest in CACHED_FILES):
+        return False
+    # copy into a private directory first so other jobs never see a partial entry
+    tmp_entry = f"{entry}.{os.getpid()}.tmp"
+    os.makedirs(tmp_entry, exist_ok=True)
+    for name, dest in CACHED_FILES:
+        shutil.copyfile(dest.format(sample=sample), os.path.join(tmp_entry, name))
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # another job stored the same sample first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        return False
+    return True
+
+
+def evict_lru(cache_dir, max_bytes):
+    entries = []
+    for prefix in os.listdir(cache_dir):
+        prefix_dir = os.path.join(cache_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for key in os.listdir(prefix_dir):
+            entry = os.path.join(prefix_dir, key)
+            if key.endswith(".tmp") or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                # evicted by another job during the scan
+                continue
+    total = sum(size for mtime, size, entry in entries)
+    evicted = 0
+    for mtime, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        # move the entry out of place first, the scans and restores of other jobs skip .tmp names
+        tmp_entry = f"{entry}.{os.getpid()}.evict.tmp"
+        try:
+            os.rename(entry, tmp_entry)
+        except OSError:
+            # another job evicted it first
+            total -= size
+            continue
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        total -= size
+        evicted += 1
+    return evicted
+
+
+def restore_results(config, sample_registry, workers):
+    # hash the inputs of every sample and restore the ones already in the cache
+    # returns the cache key and "hit" or "miss" for each sample
+    cache_dir = config["result_cache_dir"]
+    reference_hashes = {
+        "barcodes": file_sha256(config["barcodes_path"]),
+        "curated_lineages": file_sha256(config["curated_lineages_path"]),
+    }
+    # results of an earlier release of the tools are not restored after an upgrade
+    tools = tool_versions()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # with pipelined staging the reads are only staged by snakemake, hash them where they are
+        read_hashes = {sample: pool.map(file_sha256, lib.get("sources", lib["reads"])) for sample, lib in sample_registry.items()}
+        read_hashes = {sample: list(hashes) for sample, hashes in read_hashes.items()}
+    keys = {}
+    status = {}
+    for sample, lib in sample_registry.items():
+        keys[sample] = sample_cache_key(lib, read_hashes[sample], config, reference_hashes, tools)
+        status[sample] = "hit" if restore_sample(cache_dir, keys[sample], sample) else "miss"
+    hits = list(status.values()).count("hit")
+    msg = f"result cache: {hits} hits, {len(status) - hits} misses \n"
+    sys.stderr.write(msg)
+    return keys, status
+
+
+def store_results(config, keys, status):
+    # add the samples computed by this job to the cache, then trim it to size
+    cache_dir = config["result_cache_dir"]
+    stored = 0
+    for sample, key in keys.items():
+        if status.get(sample) == "miss" and store_sample(cache_dir, key, sample):
+            stored += 1
+    max_bytes = float(config.get("result_cache_max_gb", 500)) * 1024 ** 3
+    evicted = evict_lru(cache_dir, max_bytes)
+    msg = f"result cache: stored {stored} samples, evicted {evicted} entries \n"
+    sys.stderr.write(msg)
+    return
+
+
+def write_cache_status(status, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fh:
+        json.dump(status, fh, indent=4)
+    return
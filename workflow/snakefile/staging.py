@@ -0,0 +1,148 @@
+import errno
+import fcntl
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+#
+# Staging of the input reads under their sample id names.
+# localize_libraries has already put the reads in the staging directory, so
+# each read file is given its new name without copying it where the
+# filesystem allows: a hardlink, then a reflink (copy on write clone), then a
+# symlink, and only then a copy. Copies are split into chunks that a pool of
+# threads copies side by side, which keeps a parallel filesystem busy.
+# A strategy that the filesystem does not support for one file is not tried
+# again for the rest of the batch.
+# Staging runs either all at once in the wrapper before snakemake starts, or
+# pipelined as one stage_reads job per read file in the wastewater snakefile,
+# where each sample moves on to assembly as soon as its own reads are staged.
+#
+
+# tried in this order, config["staging_strategies"] can leave some out
+STAGING_STRATEGIES = ["hardlink", "reflink", "symlink", "copy"]
+
+# errors meaning the filesystem or the mount does not support a strategy
+UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EPERM, errno.EACCES, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EMLINK}
+
+# linux FICLONE ioctl, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+
+# stage_reads jobs run side by side in the snakemake process and share the report
+report_lock = threading.Lock()
+
+
+def hardlink(src, dest):
+    os.link(src, dest)
+
+
+def reflink(src, dest):
+    with open(src, "rb") as src_fh, open(dest, "wb") as dest_fh:
+        try:
+            fcntl.ioctl(dest_fh.fileno(), FICLONE, src_fh.fileno())
+        except OSError:
+            dest_fh.close()
+            os.unlink(dest)
+            raise
+
+
+def symlink(src, dest):
+    os.symlink(os.path.abspath(src), dest)
+
+
+LINK_STRATEGIES = {"hardlink": hardlink, "reflink": reflink, "symlink": symlink}
+
+
+def copy_chunk(task):
+    src, dest, offset, length = task
+    with open(src, "rb") as src_fh, open(dest, "r+b") as dest_fh:
+        done = 0
+        while done < length:
+            try:
+                # in kernel copy, server side on NFS 4.2
+                copied = os.copy_file_range(src_fh.fileno(), dest_fh.fileno(), length - done, offset + done, offset + done)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRORS:
+                    raise
+                # older kernels do not copy across filesystems
+                copied = os.pwrite(dest_fh.fileno(), os.pread(src_fh.fileno(), min(length - done, 8 * 1024 * 1024), offset + done), offset + done)
+            if copied == 0:
+                break
+            done += copied
+    return done
+
+
+def parallel_copy(files, workers):
+    # copy every file in COPY_CHUNK_BYTES chunks spread over a pool of threads
+    if not hasattr(os, "copy_file_range"):
+        for src, dest in files:
+            shutil.copy(src, dest)
+        return
+    tasks = []
+    for src, dest in files:
+        size = os.path.getsize(src)
+        with open(dest, "wb") as dest_fh:
+            dest_fh.truncate(size)
+        tasks += [(src, dest, offset, min(COPY_CHUNK_BYTES, size - offset)) for offset in range(0, size, COPY_CHUNK_BYTES)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(copy_chunk, tasks))
+    return
+
+
+def stage_files(files, strategies=STAGING_STRATEGIES, workers=8):
+    # stage (source, destination) pairs, returns (source, destination, strategy, bytes copied) for each file
+    start = time.time()
+    strategies = [strategy for strategy in strategies if strategy in STAGING_STRATEGIES]
+    unsupported = set()
+    staged = []
+    to_copy = []
+    for src, dest in files:
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        for strategy in strategies:
+            if strategy in unsupported:
+                continue
+            if strategy == "copy":
+                to_copy.append((src, dest))
+                staged.append((src, dest, strategy, os.path.getsize(src)))
+                break
+            try:
+                LINK_STRATEGIES[strategy](src, dest)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRORS:
+                    raise
+                unsupported.add(strategy)
+                continue
+            staged.append((src, dest, strategy, 0))
+            break
+        else:
+            raise OSError(f"could not stage {src} with any of {strategies}")
+    if to_copy:
+        parallel_copy(to_copy, workers)
+    # new files keep the time stamps of their source like a link does, so snakemake
+    # does not see reads staged again as newer than results restored from the cache
+    for src, dest, strategy, copied in staged:
+        if strategy in ("reflink", "copy"):
+            shutil.copystat(src, dest)
+    used = [strategy for src, dest, strategy, copied in staged]
+    msg = (f"staging: {len(staged)} read files in {time.time() - start:.1f}s, "
+        f"{', '.join(f'{strategy} {used.count(strategy)}' for strategy in strategies if strategy in used)}, "
+        f"{sum(copied for src, dest, strategy, copied in staged) / 1024 ** 3:.2f} GB copied \n")
+    sys.stderr.write(msg)
+    return staged
+
+
+def write_staging_report(staged, path):
+    # adds the staged files to the report, the header is written with the first ones
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with report_lock:
+        header = not os.path.exists(path)
+        with open(path, "a") as fh:
+            if header:
+                fh.write("source\tfile\tstrategy\tbytes_copied\n")
+            fh.write("".join(f"{src}\t{dest}\t{strategy}\t{copied}\n" for src, dest, strategy, copied in staged))
+    return
@@ -7,17 +7,66 @@ import csv
 import json
 import os
 import pandas as pd
-import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import time
 
+import result_cache
+import staging
+# the job state manifest is shared with the scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import job_state
+import fastq_preflight
+import freyja_aggregator
 
 #
 # python wrapper for the SARS2Waterwater analysis pipeline
 # is designed to be executed by App-SARS2Wastewater perl script
 #
 
+class SnakemakeJobTimer:
+    # snakemake log handler that records when each job starts and finishes
+    # so the wrapper can tell scheduling overhead apart from time spent in jobs
+    def __init__(self):
+        self.started = {}
+        self.intervals = []
+
+    def log_handler(self, msg):
+        level = msg.get("level")
+        if level == "job_info":
+            self.started[msg.get("jobid")] = time.time()
+        elif level in ("job_finished", "job_error"):
+            start = self.started.pop(msg.get("jobid"), None)
+            if start is not None:
+                self.intervals.append((start, time.time()))
+
+    def busy_time(self):
+        # wall time where at least one job was running
+        busy = 0
+        busy_start, busy_end = None, None
+        for start, end in sorted(self.intervals):
+            if busy_end is None or start > busy_end:
+                if busy_end is not None:
+                    busy += busy_end - busy_start
+                busy_start, busy_end = start, end
+            else:
+                busy_end = max(busy_end, end)
+        if busy_end is not None:
+            busy += busy_end - busy_start
+        return busy
+
+
+def add_to_config_file(config_file, key, value):
+    with open(config_file, 'r') as file:
+        config = json.load(file)
+    config[key] = value
+    with open(config_file, 'w') as file:
+        json.dump(config, file, indent=4)
+    return
+
+
 def check_for_error_msgs(raw_msg, file, out_msg):
     with open(file, 'r') as fp:
         lines = fp.readlines()
@@ -81,7 +130,17 @@ def format_inputs(raw_params):
     return input_dict
 
 
+def parse_memory_mb(memory):
+    # memory is given like the preflight value ("16G", "500M") or as bytes
+    memory = str(memory).strip().upper().rstrip("B")
+    units = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024}
+    if memory[-1:] in units:
+        return int(float(memory[:-1]) * units[memory[-1]])
+    return int(int(memory) / (1024 * 1024))
+
+
 def post_processing_check(all_sample_ids, output_dir):
+    state = job_state.JobState()
     dict_samples = {}
     complete = []
     incomplete = []
@@ -91,7 +150,7 @@ def post_processing_check(all_sample_ids, output_dir):
         # missing demix results
         # check for missing demix results
         freyja_path = f"{output_dir}/{sample_name}/freyja/{sample_name}_freyja_result.tsv"
-        if os.path.isfile(freyja_path) == True:
+        if state.exists(freyja_path):
             msg = f"{sample_name}"
             complete.append(msg)
         else:
@@ -115,37 +174,13 @@ def post_processing_check(all_sample_ids, output_dir):
             demix_error_file = f"tmp/{sample}_demix_error.txt"
             if os.path.exists(demix_error_file):
                 check_for_error_msgs(raw_msg, demix_error_file, out_msg)
-            ### Check sample plots ##
-            # variant plot
-            raw_msg = "ERROR: No samples matching coverage requirements, so no plot will be generated."
-            out_msg = "The Freyja plot command gave this error for {sample}: \n 'ERROR: No samples matching \
-                coverage requirements, so no plot will be generated.' \
-                The default coverage requirement is 60% \n"
-            sample_plot_error_variant_file = f"tmp/{sample}_sample_variant_plot_error.txt"
-            if os.path.exists(sample_plot_error_variant_file):
-                check_for_error_msgs(raw_msg, sample_plot_error_variant_file, out_msg)
-            # linage plot
-            raw_msg = "ERROR: No samples matching coverage requirements, so no plot will be generated."
-            out_msg = "The Freyja plot command with flag '--lineage' gave this error for {sample}: \n 'ERROR: No samples matching \
-                coverage requirements, so no plot will be generated.' \
-                The default coverage requirement is 60% \n"
-            sample_plot_error_lineage_file = f"tmp/{sample}_sample_lineage_plot_error.txt"
-            if os.path.exists(sample_plot_error_lineage_file):
-                check_for_error_msgs(raw_msg, sample_plot_error_variant_file, out_msg)
-            # lineage plot coverage depth error
-            # lineage plot too many lineages error
-            raw_msg = "Exception: Too many lineages to show. Use --config to group."
-            out_msg = "The Freyja plot command with flag '--lineage' gave this error for {sample}: \n \
-                'Exception: Too many lineages to show.'"
-            if os.path.exists(sample_plot_error_lineage_file):
-                check_for_error_msgs(raw_msg, sample_plot_error_lineage_file, out_msg)
     else:
         msg = f"Freyja results produced for the following samples: {complete}. \n"
         sys.stderr.write(msg)
         return True
 
 
-def preprocessing_check(output_dir, input_dict):
+def preprocessing_check(output_dir, input_dict, preflight_failed):
     ## Using the input dictionary instead of path from staging directory due to file name confusion
     # Parse "sample_id" from "paired_end_libs"
     paired_sample_ids = [item["sample_id"] for item in input_dict.get("paired_end_libs", [])]
@@ -159,16 +194,12 @@ def preprocessing_check(output_dir, input_dict):
     all_sample_ids = paired_sample_ids + single_sample_ids + srr_sample_ids
 
     # Edit the sample ids to match the sample ids defined in set-up-sample-dictionary(input_dir input_dict output_dir cores)
-    clean_sample_ids = []
-    for sample_id in all_sample_ids:
-        # Define a regular expression pattern to match all special characters except underscore
-        pattern = r"[^a-zA-Z0-9_]"
-        # Use the re.sub() function to replace all matches of the pattern with an empty string
-        sample_id = re.sub(pattern, "", sample_id)
-        clean_sample_ids.append(sample_id)
-    all_sample_ids = clean_sample_ids
-        
-    # file check for preprocessing/sars-one-codex
+    all_sample_ids = [job_state.clean_sample_id(sample_id) for sample_id in all_sample_ids]
+    # samples dropped by the FASTQ preflight were never assembled, their warning is already written
+    all_sample_ids = [sample_id for sample_id in all_sample_ids if sample_id not in preflight_failed]
+
+    # file check for preprocessing/sars-one-codex from the job state manifest
+    state = job_state.JobState()
     dict_samples = {}
     complete = []
     incomplete = []
@@ -182,8 +213,8 @@ def preprocessing_check(output_dir, input_dict):
 
         ### check for incorrect sequencing type ###
         # if the wrong sequencing type is given the stats file will be empty
-        if os.path.isfile(stats_path) == True:
-            if os.path.getsize(stats_path) == 0:
+        if state.exists(stats_path):
+            if not state.nonempty(stats_path):
                 wrong_sequence_type.append(sample_name)
             else:
                 msg = f"assembly complete for {sample_name} \n"
@@ -191,7 +222,7 @@ def preprocessing_check(output_dir, input_dict):
         else:
             wrong_sequence_type.append(sample_name)
         ### check for assembly results ###
-        if os.path.isfile(iVar_bam) == True:
+        if state.exists(iVar_bam):
             complete.append(sample_name)
         else:
             dict_samples[sample_name] = False
@@ -208,7 +239,7 @@ def preprocessing_check(output_dir, input_dict):
                 Primer trimming and variant calling is complete for the following samples: {complete}. \n \
                 CHECK SAMPLE: Primer trimming and variant calling is INCOMPLETE for the following samples: **{incomplete}** \n \
                 Please review the sample(s) by uploading the FASTQ file(s) to the FastqUtils service.\n \
-                Ending job. Not proceeding with the rest of the analysis due to errors in FASTQ proccessing \n"
+                The rest of the analysis was not run for these samples due to errors in FASTQ proccessing \n"
             write_to_warning_file(msg)
     ## if an iVAR trimmed bam file does not exist but statstics.tsv exisits 
     elif len(incomplete) != 0:
@@ -216,7 +247,7 @@ def preprocessing_check(output_dir, input_dict):
                 Primer trimming and variant calling is complete for the following samples: {complete}. \n \
                 CHECK SAMPLE: Primer trimming and variant calling is INCOMPLETE for the following samples: **{incomplete}** \n \
                 Please review the sample(s) by uploading the FASTQ file(s) to the FastqUtils service.\n \
-                Ending job. Not proceeding with the rest of the analysis due to errors in FASTQ proccessing \n"
+                The rest of the analysis was not run for these samples due to errors in FASTQ proccessing \n"
         write_to_warning_file(msg)
     ## if the statistics file is empty it is probably the wrong sequencing type write inormative message and stop the analysis 
     elif len(wrong_sequence_type) !=0:
@@ -224,13 +255,16 @@ def preprocessing_check(output_dir, input_dict):
                 CHECK SEQUENCING TYPE: \n \
                 \n This service only accepts amplicon based sequencing. \n \
                 Please check the sequencing type for the following samples: **{wrong_sequence_type}** \n \
-                Ending job. Not proceeding with the rest of the analysis due to errors in FASTQ proccessing"
+                The rest of the analysis was not run for these samples due to errors in FASTQ proccessing"
         write_to_warning_file(msg)
     else:
         #all samples complete 
         msg = "assembly is complete for all samples\n"
     if len(complete) == 0:
-        msg = f"Assembly did not complete for any samples: {all_sample_ids}.\n Please review your samples"
+        if len(all_sample_ids) == 0 and len(preflight_failed) != 0:
+            msg = f"No samples passed the FASTQ check: {list(preflight_failed)}.\n Please review your samples"
+        else:
+            msg = f"Assembly did not complete for any samples: {all_sample_ids}.\n Please review your samples"
         write_to_job_failed_file(msg)
         sys.stderr.write(msg)
         sys.exit(1)
@@ -240,46 +274,148 @@ def preprocessing_check(output_dir, input_dict):
         return complete
 
 
-def run_snakefiles(input_dict, input_dir, output_dir,  config):
-    input_dir = config["input_data_dir"]
-    SNAKEMAKE_PATH = config["snakemake"]
-    SNAKEFILE_DIR = f"{config['workflow_dir']}/snakefile/"
-    common_params = [
-        SNAKEMAKE_PATH,
-        "--cores", str(config["cores"]),
-        "--use-singularity",
-        "--verbose",
-        "--printshellcmds",
-        "--keep-going"
-        ]
-
-    if config["cores"] == 1:
-        common_params.append("--debug")
-    # process any paired reads
-    if os.path.exists(f"{input_dir}/pe_reads"):
-        msg = "starting paired end reads\n"
+# run_snakemake relies on the snakemake() API function and --log-handler-script,
+# both were removed in Snakemake 8
+SNAKEMAKE_MAX_MAJOR = 7
+
+def snakemake_version(config):
+    # version of the snakemake run_snakemake will use, the python API or the snakemake executable
+    if config.get("snakemake_mode", "api") == "api":
+        try:
+            import snakemake
+            return snakemake.__version__
+        except ImportError:
+            pass
+    try:
+        result = subprocess.run([config["snakemake"], "--version"], capture_output=True, text=True)
+    except (KeyError, OSError):
+        return None
+    return result.stdout.strip() or None
+
+def check_snakemake_version(config):
+    version = snakemake_version(config)
+    major = version.split(".")[0] if version else ""
+    if not major.isdigit() or int(major) > SNAKEMAKE_MAX_MAJOR:
+        msg = (f"Snakemake {version or 'not found'}: this workflow needs Snakemake {SNAKEMAKE_MAX_MAJOR} or earlier, "
+            f"it uses the snakemake() API and --log-handler-script of those releases \n")
         sys.stderr.write(msg)
-        SNAKEFILE = os.path.join(SNAKEFILE_DIR, "pe_freyja_snakefile")
-        cmd = common_params + ["--snakefile",  SNAKEFILE]
+        sys.exit(1)
+    msg = f"Snakemake {version} \n"
+    sys.stderr.write(msg)
+
+def run_snakemake(snakefile, config, stage, targets=None):
+    # run one snakefile either in process through the snakemake API (default)
+    # or as a separate snakemake process
+    cores = int(config["cores"])
+    timer = None
+    snakemake_api = None
+    if config.get("snakemake_mode", "api") == "api":
+        try:
+            from snakemake import snakemake as snakemake_api
+        except ImportError:
+            msg = "snakemake python API is not available, running snakemake as a subprocess \n"
+            sys.stderr.write(msg)
+    start = time.time()
+    if snakemake_api is not None:
+        timer = SnakemakeJobTimer()
+        # every finished job is added to the job state manifest
+        state = job_state.JobState(read=False)
+        snakemake_api(
+            snakefile,
+            cores=cores,
+            use_singularity=True,
+            verbose=True,
+            printshellcmds=True,
+            keepgoing=True,
+            targets=targets,
+            debug=(cores == 1),
+            resources={"mem_mb": config["memory_mb"]},
+            log_handler=[timer.log_handler, state.log_handler]
+            )
+    else:
+        cmd = [
+            config["snakemake"],
+            "--cores", str(cores),
+            "--use-singularity",
+            "--verbose",
+            "--printshellcmds",
+            "--keep-going",
+            "--resources", f"mem_mb={config['memory_mb']}",
+            "--snakefile", snakefile,
+            "--log-handler-script", os.path.abspath(job_state.__file__)
+            ]
+        if cores == 1:
+            cmd.append("--debug")
+        if targets is not None:
+            cmd.extend(targets)
         subprocess.run(cmd)
-    # process any single reads
-    if os.path.exists(f"{input_dir}/se_reads"):
-        SNAKEFILE = os.path.join(SNAKEFILE_DIR, "se_freyja_snakefile")
-        msg = "starting single end reads\n"
+    end = time.time()
+    wall = end - start
+    if timer is not None and len(timer.intervals) != 0:
+        first_job = min(job_start for job_start, job_end in timer.intervals)
+        busy = timer.busy_time()
+        job_time = sum(job_end - job_start for job_start, job_end in timer.intervals)
+        msg = (f"{stage} timing: wall {wall:.1f}s, DAG build before first job {first_job - start:.1f}s, "
+            f"jobs running {busy:.1f}s, scheduling overhead {wall - busy:.1f}s, "
+            f"{len(timer.intervals)} jobs totaling {job_time:.1f}s \n")
+    else:
+        msg = f"{stage} timing: wall {wall:.1f}s \n"
+    sys.stderr.write(msg)
+    return
+
+
+def run_snakefiles(input_dict, input_dir, output_dir,  config):
+    SNAKEFILE_DIR = f"{config['workflow_dir']}/snakefile/"
+    # process every sample from assembly through freyja demix in one DAG
+    # each sample moves on as soon as its own assembly is done and
+    # --keep-going limits a failure to the branch of the failed sample
+    if len(config["sample_registry"]) != 0:
+        # the cohort demix table starts from the samples of this job already aggregated,
+        # one row each, so a resumed job or a reused job directory adds no second rows
+        freyja_aggregator.rebuild_cohort([f"output/{sample}/{sample}_aggregated_result.tsv" for sample in config["sample_registry"]])
+        # samples already processed by an earlier job with the same reads and settings
+        # are restored from the result cache and skipped by snakemake
+        cache_keys = None
+        if config.get("result_cache_dir") and not config.get("recompute_dir"):
+            cache_keys, cache_status = result_cache.restore_results(config, config["sample_registry"], min(8, int(config["cores"])))
+            result_cache.write_cache_status(cache_status, "tmp/result_cache_status.json")
+            # snakemake skips the restored samples, add their files to the job state manifest here
+            state = job_state.JobState(read=False)
+            for sample, status in cache_status.items():
+                if status == "hit":
+                    state.record("result_cache", sample, [path.format(sample=sample) for name, path in result_cache.CACHED_FILES])
+            # the raw read fastqc of a restored sample still needs its reads, staged by the stage_reads rule
+            # they would look newer than the restored assembly, so stage them here with the time stamps of their source
+            hit_reads = [(source, read) for sample, lib in config["sample_registry"].items() if cache_status[sample] == "hit"
+                         for source, read in zip(lib.get("sources", []), lib["reads"])]
+            if len(hit_reads) != 0:
+                staged = staging.stage_files(hit_reads, config.get("staging_strategies", staging.STAGING_STRATEGIES), min(8, int(config["cores"])))
+                staging.write_staging_report(staged, "tmp/staging.tsv")
+        msg = "starting per sample processing\n"
         sys.stderr.write(msg)
-        cmd = common_params + ["--snakefile",  SNAKEFILE]
-        subprocess.run(cmd)
-    # once the snake files complete, check for the iVar bam files
-    complete = preprocessing_check(output_dir, input_dict)
+        SNAKEFILE = os.path.join(SNAKEFILE_DIR, "wastewater_snakefile")
+        if config.get("demix_mode", "batch") == "batch":
+            # stop before demix, solve every sample in one process that loads the barcodes once,
+            # then finish the DAG - freyja demix only runs for samples the batch could not solve
+            run_snakemake(SNAKEFILE, config, "per sample processing", targets=["all_before_demix"])
+            batch_demix = os.path.join(config["workflow_dir"], "scripts", "batch_demix.py")
+            cmd = ["python3", batch_demix, "tmp/batch_demix_timing.tsv"]
+            subprocess.run(cmd)
+            run_snakemake(SNAKEFILE, config, "per sample demix")
+        else:
+            run_snakemake(SNAKEFILE, config, "per sample processing")
+        if cache_keys is not None:
+            result_cache.store_results(config, cache_keys, cache_status)
+    if config.get("recompute_dir"):
+        # there is no assembly to check when recomputing demix from an earlier job
+        complete = list(config["sample_registry"])
+    else:
+        # once every sample branch has settled, check for the iVar bam files
+        complete = preprocessing_check(output_dir, input_dict, config.get("preflight_failed", {}))
 
-    print('starting freyja command')
-    SNAKEFILE = os.path.join(SNAKEFILE_DIR, "freyja_snakefile")
-    cmd = common_params + ["--snakefile",  SNAKEFILE]
-    subprocess.run(cmd)
     print('starting stats/wrap up command')
     SNAKEFILE = os.path.join(SNAKEFILE_DIR, "stats_snakefile")
-    cmd = common_params + ["--snakefile",  SNAKEFILE]
-    subprocess.run(cmd)
+    run_snakemake(SNAKEFILE, config, "stats/wrap up")
     # final file check for only the samples that passed iVar trimming
     freyja_check = post_processing_check(complete, output_dir)
     if freyja_check == True:
@@ -298,9 +434,88 @@ def run_snakefiles(input_dict, input_dir, output_dir,  config):
     return
 
 
-def set_up_sample_dictionary(input_dir, input_dict, output_dir, cores):
+def set_up_recompute(recompute_dir, output_dir):
+    # demix recompute: reuse the freyja variants and depths of an earlier job
+    # they do not depend on the barcodes, so only demix and the wrap up run again
+    previous_registry = {}
+    previous_registry_path = os.path.join(recompute_dir, "sample_registry.json")
+    if os.path.isfile(previous_registry_path):
+        with open(previous_registry_path) as file:
+            previous_registry = json.load(file)
+    sample_registry = {}
+    state = job_state.JobState(read=False)
+    for sample_id in sorted(os.listdir(recompute_dir)):
+        variants = f"{recompute_dir}/{sample_id}/freyja/{sample_id}_freyja_variants.tsv"
+        depths = f"{recompute_dir}/{sample_id}/freyja/{sample_id}_freyja.depths"
+        if not (os.path.isfile(variants) and os.path.isfile(depths)):
+            continue
+        os.makedirs(f"{output_dir}/{sample_id}/freyja", exist_ok=True)
+        shutil.copy(variants, f"{output_dir}/{sample_id}/freyja/")
+        shutil.copy(depths, f"{output_dir}/{sample_id}/freyja/")
+        # keep the assembly stats so the job stats still describe the sample
+        stats_path = f"{recompute_dir}/{sample_id}/assembly/{sample_id}.statistics.tsv"
+        if os.path.isfile(stats_path):
+            os.makedirs(f"{output_dir}/{sample_id}/assembly", exist_ok=True)
+            shutil.copy(stats_path, f"{output_dir}/{sample_id}/assembly/")
+        state.record("recompute", sample_id, [
+            f"{output_dir}/{sample_id}/freyja/{sample_id}_freyja_variants.tsv",
+            f"{output_dir}/{sample_id}/freyja/{sample_id}_freyja.depths",
+            f"{output_dir}/{sample_id}/assembly/{sample_id}.statistics.tsv"])
+        lib = previous_registry.get(sample_id, {})
+        sample_registry[sample_id] = {
+            "layout": lib.get("layout", "pe"),
+            "zipped": lib.get("zipped", False),
+            "reads": [],
+            "primers": lib.get("primers"),
+            "primer_version": lib.get("primer_version"),
+            "sample_level_date": lib.get("sample_level_date")
+            }
+    if len(sample_registry) == 0:
+        msg = f"No freyja variants and depths files found in {recompute_dir}. \n Please check the previous job's output folder"
+        write_to_job_failed_file(msg)
+        sys.stderr.write(msg)
+        sys.exit(1)
+    msg = f"recomputing demix for {len(sample_registry)} samples from {recompute_dir} \n"
+    sys.stderr.write(msg)
+    return sample_registry
+
+
+def preflight_samples(sample_registry, config):
+    # check the start of every FASTQ and drop the samples whose reads can not be assembled,
+    # returns the registry of the samples left and the reason for each sample dropped
+    if not config.get("primer_schemes_dir"):
+        msg = "preflight: no primer_schemes_dir in the config, the reads are not checked for primer starts \n"
+        sys.stderr.write(msg)
+    preflight_df = fastq_preflight.preflight(sample_registry,
+        n_reads=int(config.get("preflight_reads", 10000)),
+        workers=min(8, int(config["cores"])),
+        full_gzip_check=config.get("preflight_gzip_check", "head") == "full",
+        primer_schemes_dir=config.get("primer_schemes_dir"),
+        min_read_length=config.get("preflight_min_read_length", 30),
+        min_primer_concordance=config.get("preflight_min_primer_concordance", fastq_preflight.MIN_PRIMER_CONCORDANCE))
+    os.makedirs("tmp", exist_ok=True)
+    preflight_df.to_csv("tmp/preflight.tsv", sep="\t", index=False)
+    failed = preflight_df[preflight_df["status"] == "fail"]
+    if len(failed) != 0:
+        reasons = "\n".join(f"    {sample}: {reason}" for sample, reason in zip(failed["sample"], failed["reason"]))
+        msg = f"WARNING: CHECK FASTQ FILE(S) \n \
+                The reads of the following samples failed the FASTQ check and were not analyzed: \n{reasons} \n \
+                Please review the sample(s) by uploading the FASTQ file(s) to the FastqUtils service.\n"
+        write_to_warning_file(msg)
+    warned = preflight_df[preflight_df["status"] == "warn"]
+    for sample, reason in zip(warned["sample"], warned["reason"]):
+        msg = f"preflight warning for {sample}: {reason} \n"
+        sys.stderr.write(msg)
+    dropped = dict(zip(failed["sample"], failed["reason"]))
+    return {sample: lib for sample, lib in sample_registry.items() if sample not in dropped}, dropped
+
+
+def set_up_sample_dictionary(input_dir, input_dict, output_dir, cores, staging_strategies, staging_mode):
     # set up the sample dictionary
     input_info = {}
+    # one registry of the clean sample ids shared by every snakefile
+    # so the snakefiles do not need to rescan the staging directory
+    sample_registry = {}
     #### paired reads ####
     to_copy = []
     if len(input_dict["paired_end_libs"]) != 0:
@@ -320,11 +535,7 @@ def set_up_sample_dictionary(input_dir, input_dict, output_dir, cores):
             read2_filename = ws_paired_reads[i]["read2"].split("/")[-1]
             read2_filepath = check_input_fastqs(input_dir, read2_filename)
             # pull out sample id
-            sample_id = ws_paired_reads[i]["sample_id"].split("/")[-1]
-            # Define a regular expression pattern to match all special characters except underscore
-            pattern = r"[^a-zA-Z0-9_]"
-            # Use the re.sub() function to replace all matches of the pattern with an empty string
-            sample_id = re.sub(pattern, "", sample_id)
+            sample_id = job_state.clean_sample_id(ws_paired_reads[i]["sample_id"])
             # collect pairs of clean sample ids and file names for sample-meta-data-file
             # input_info[sample_id] = read1_filename
             input_info[read1_filename] = sample_id
@@ -337,6 +548,14 @@ def set_up_sample_dictionary(input_dir, input_dict, output_dir, cores):
                 pe_r2_samplename = f"{sample_id}_R2.fastq"
             paired_sample_dict[read1_filename] = pe_r1_samplename
             paired_sample_dict[read2_filename] = pe_r2_samplename
+            sample_registry[sample_id] = {
+                "layout": "pe",
+                "zipped": read1_filename.endswith(".gz"),
+                "reads": [f"{input_dir}/pe_reads/{pe_r1_samplename}", f"{input_dir}/pe_reads/{pe_r2_samplename}"],
+                "primers": ws_paired_reads[i].get("primers"),
+                "primer_version": ws_paired_reads[i].get("primer_version"),
+                "sample_level_date": ws_paired_reads[i].get("sample_level_date")
+                }
 
             to_copy.append([read1_filepath, f"{input_dir}/pe_reads/{pe_r1_samplename}"])
             to_copy.append([read2_filepath, f"{input_dir}/pe_reads/{pe_r2_samplename}"])
@@ -353,11 +572,7 @@ def set_up_sample_dictionary(input_dir, input_dict, output_dir, cores):
         for i in range(len(ws_single_end_reads)):
             se_filename = ws_single_end_reads[i]["read"].split("/")[-1]
             se_filepath = check_input_fastqs(input_dir, se_filename)
-            sample_id = ws_single_end_reads[i]["sample_id"]
-            # Define a regular expression pattern to match all special characters except underscore
-            pattern = r"[^a-zA-Z0-9_]"
-            # Use the re.sub() function to replace all matches of the pattern with an empty string
-            sample_id = re.sub(pattern, "", sample_id)
+            sample_id = job_state.clean_sample_id(ws_single_end_reads[i]["sample_id"])
             # collect pairs of clean sample ids and file names for sample-meta-data-file
             input_info[se_filename] = sample_id
             if se_filename.endswith(".gz"):
@@ -365,10 +580,26 @@ def set_up_sample_dictionary(input_dir, input_dict, output_dir, cores):
             else:
                 se_samplename = f"{sample_id}.fastq"
             single_end_sample_dict[se_filename] = se_samplename
+            sample_registry[sample_id] = {
+                "layout": "se",
+                "zipped": se_filename.endswith(".gz"),
+                "reads": [f"{input_dir}/se_reads/{se_samplename}"],
+                "primers": ws_single_end_reads[i].get("primers"),
+                "primer_version": ws_single_end_reads[i].get("primer_version"),
+                "sample_level_date": ws_single_end_reads[i].get("sample_level_date")
+                }
             to_copy.append([se_filepath, f"{input_dir}/se_reads/{se_samplename}"])
 
-    for (src, dest) in to_copy:
-        shutil.copy(src, dest)
+    if staging_mode == "pipelined":
+        # the stage_reads rule stages each read as a snakemake job, so a sample's assembly
+        # starts as soon as its own reads are in place
+        sources = {dest: src for (src, dest) in to_copy}
+        for lib in sample_registry.values():
+            lib["sources"] = [sources[read] for read in lib["reads"]]
+    else:
+        # give the reads their sample id names, linking them in place where the filesystem allows
+        staged = staging.stage_files(to_copy, staging_strategies, cores)
+        staging.write_staging_report(staged, "tmp/staging.tsv")
 
     # export the sample dictionary to .CSV
     with open(f"{output_dir}/sample_key.csv", "w", newline="") as file:
@@ -380,7 +611,7 @@ def set_up_sample_dictionary(input_dir, input_dict, output_dir, cores):
         if len(input_dict["single_end_libs"]) != 0:
             for key, value in single_end_sample_dict.items():
                 writer.writerow([key, value])
-    return input_info
+    return input_info, sample_registry
 
 
 def write_to_warning_file(message):
@@ -411,17 +642,53 @@ def main(argv):
         sys.stderr.write(msg)
         sys.exit(1)
 
+    # fail before staging any reads when snakemake cannot run the workflow
+    check_snakemake_version(config)
     input_dict = config["params"]
     input_dir = config["input_data_dir"]
     output_dir = config["output_data_dir"]
     staging_metadata_file = config["staging_sample_metadata_path"]
 
-    # rename files according to sample ids, copy files to pe_reads and se_reads in the staging directory
-    input_info = set_up_sample_dictionary(input_dir, input_dict, output_dir, min(8, int(config["cores"])))
-    # if a user provided metadata csv exists, make sure it matches the reads given
-    check_sample_metadata_csv(input_info, config_file, input_dir, staging_metadata_file)
+    if config.get("recompute_dir"):
+        # only demix and the wrap up run again, on the variants of an earlier job
+        sample_registry = set_up_recompute(config["recompute_dir"], output_dir)
+        add_to_config_file('config.json', "edited_sample_metadata_csv", "")
+    else:
+        # rename files according to sample ids, link or copy files to pe_reads and se_reads in the staging directory
+        staging_strategies = config.get("staging_strategies", staging.STAGING_STRATEGIES)
+        # staging_mode pipelined (default) stages the reads in the snakemake DAG, upfront stages them all here first
+        staging_mode = config.get("staging_mode", "pipelined")
+        input_info, sample_registry = set_up_sample_dictionary(input_dir, input_dict, output_dir, min(8, int(config["cores"])), staging_strategies, staging_mode)
+        # if a user provided metadata csv exists, make sure it matches the reads given
+        check_sample_metadata_csv(input_info, config_file, input_dir, staging_metadata_file)
+        # preflight (default on) keeps samples with corrupt or non amplicon reads out of the assembly
+        # the samples dropped stay in the job stats and the report as failed preflight
+        if config.get("preflight", True):
+            sample_registry, config["preflight_failed"] = preflight_samples(sample_registry, config)
+            add_to_config_file('config.json', "preflight_failed", config["preflight_failed"])
+    # share the sample registry with the snakefiles through config.json
+    config["sample_registry"] = sample_registry
+    add_to_config_file('config.json', "sample_registry", sample_registry)
+    # saved with the results so a later job can recompute demix from this one
+    with open(f"{output_dir}/sample_registry.json", "w") as file:
+        json.dump(sample_registry, file, indent=4)
+    # memory budget for the snakemake scheduler, leaving room for the wrapper and snakemake itself
+    config["memory_mb"] = int(parse_memory_mb(config.get("memory", "16G")) * 0.9)
+    add_to_config_file('config.json', "memory_mb", config["memory_mb"])
+    # demix solver options shared by the freyja_demix rule and the batch demix, freyja's own defaults unless set
+    for key, default in [("demix_adapt", 0.0), ("demix_a_eps", 1e-8)]:
+        config[key] = float(config.get(key, default))
+        add_to_config_file('config.json', key, config[key])
+    # decompress_reads puts the decompressed reads on node-local scratch when the job is given one
+    scratch = None
+    if config.get("decompress_reads") and config.get("scratch_dir") and not os.path.lexists("decompressed"):
+        scratch = tempfile.mkdtemp(prefix="sars2ww_reads_", dir=config["scratch_dir"])
+        os.symlink(scratch, "decompressed")
     # run the snakefiles
     run_snakefiles(input_dict, input_dir, output_dir, config)
+    if scratch is not None:
+        shutil.rmtree(scratch, ignore_errors=True)
+        os.unlink("decompressed")
 
 if __name__ == "__main__":
     main(sys.argv)
\ No newline at end of file